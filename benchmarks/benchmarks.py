@@ -0,0 +1,192 @@
+"""
+Benchmarks of the catalogue's hot paths, run with asv (see asv.conf.json)
+
+    asv run                          # benchmark the latest commit
+    asv continuous main HEAD         # compare with main, failing on regressions
+    asv run --bench Query            # only some of the benchmarks
+
+The archives and catalogues benchmarked are synthetic (see synthetic.py), written
+to the benchmark's working directory by setup_cache.
+"""
+
+import os, io, contextlib, importlib, tempfile
+import numpy as np
+
+from . import synthetic
+
+
+def _catalogue_module(path):
+    '''
+    esmcat.catalogue, with ~/.esmcat replaced by path and the synthetic datasets added
+    '''
+    import esmcat
+    os.makedirs(path, exist_ok=True)
+    setattr(esmcat, '__esmcat_path', path)
+    C = importlib.import_module('esmcat.catalogue')
+    for dataset, dataset_dict in synthetic.dataset_dictionaries(os.path.dirname(path)).items():
+        C.dataset_dictionaries[dataset] = dataset_dict
+    return C
+
+
+def _quiet():
+    '''
+    Hide progress messages (e.g., catalogue memory usage) while timing
+    '''
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+
+class BuildCatalogue:
+    '''
+    Building catalogues by walking the archive (__refresh_shared_catalogue) and from scan files
+    (__build_catalogue_from_scans), from scratch and when nothing has changed
+    '''
+    params      = ['small', 'medium']
+    param_names = ['size']
+    timeout     = 600
+    number      = 1
+    repeat      = 3
+
+    def setup_cache(self):
+        for size in self.params:
+            synthetic.make_archive(os.path.abspath(size), **synthetic.sizes[size])
+
+    def setup(self, size):
+        self.C = _catalogue_module(tempfile.mkdtemp(dir=os.path.abspath(size)))
+        self.refresh = getattr(self.C, '__refresh_shared_catalogue')
+        self.build   = getattr(self.C, '__build_catalogue_from_scans')
+        self.cat_file = os.path.join(getattr(importlib.import_module('esmcat'), '__esmcat_path'),
+                                        'synthetic_scans_catalogue.parquet')
+        with _quiet():
+            self.refresh('synthetic', incremental=False)
+            self.build('synthetic_scans', self.C.dataset_dictionaries['synthetic_scans'], self.cat_file)
+
+    def time_refresh_shared_catalogue(self, size):
+        with _quiet():
+            self.refresh('synthetic', incremental=False)
+
+    def time_refresh_shared_catalogue_unchanged(self, size):
+        with _quiet():
+            self.refresh('synthetic', incremental=True)
+
+    def time_build_catalogue_from_scans(self, size):
+        with _quiet():
+            self.build('synthetic_scans', self.C.dataset_dictionaries['synthetic_scans'], self.cat_file,
+                        incremental=False)
+
+    def time_build_catalogue_from_scans_unchanged(self, size):
+        with _quiet():
+            self.build('synthetic_scans', self.C.dataset_dictionaries['synthetic_scans'], self.cat_file)
+
+
+
+class Query:
+    '''
+    Reading and filtering catalogues (read_parquet, __filter_cat_by_dictionary and
+    complete_var_set) of synthetic catalogues of about 4 thousand and 400 thousand rows
+    '''
+    params      = ['medium', 'huge']
+    param_names = ['size']
+    timeout     = 600
+
+    filters = {'MIP':['CMIP'], 'Experiment':['historical'], 'CMOR':['Amon'], 'Var':['tas']}
+    var_set = {'MIP':['CMIP'], 'Experiment':['historical'], 'CMOR':['Amon'], 'Var':['tas', 'pr', 'psl']}
+
+    def setup_cache(self):
+        for size in self.params:
+            path = os.path.abspath(os.path.join(size, 'esmcat'))
+            C    = _catalogue_module(path)
+            C._write_parquet(synthetic.make_catalogue(**synthetic.sizes[size]),
+                                os.path.join(path, 'synthetic_catalogue.parquet'))
+
+    def setup(self, size):
+        self.C        = _catalogue_module(os.path.abspath(os.path.join(size, 'esmcat')))
+        self.cat_file = self.C.setup_catalogue_file('synthetic')
+        with _quiet():
+            self.cat = self.C.read_parquet(self.cat_file)
+        self.index  = getattr(self.C, '__build_index')(self.cat)[0]
+        self.filter = getattr(self.C, '__filter_cat_by_dictionary')
+
+    def time_read_parquet(self, size):
+        with _quiet():
+            self.C.read_parquet(self.cat_file)
+
+    def time_read_parquet_filtered(self, size):
+        with _quiet():
+            self.C.read_parquet(self.cat_file, filters=self.filters)
+
+    def time_read_parquet_lazy(self, size):
+        with _quiet():
+            self.C.read_parquet(self.cat_file, lazy=True)
+
+    def peakmem_read_parquet(self, size):
+        with _quiet():
+            self.C.read_parquet(self.cat_file)
+
+    def time_filter_cat_by_dictionary(self, size):
+        with _quiet():
+            self.filter(self.cat, dict(self.filters), index=self.index)
+
+    def time_filter_cat_by_dictionary_no_index(self, size):
+        with _quiet():
+            self.filter(self.cat, dict(self.filters))
+
+    def time_complete_var_set(self, size):
+        with _quiet():
+            self.filter(self.cat, dict(self.var_set), complete_var_set=True, index=self.index)
+
+    def time_catalogue_query(self, size):
+        with _quiet():
+            self.C.Catalogue().query(dataset='synthetic', **self.filters)
+
+
+
+class FileDates:
+    '''
+    Parsing the dates of file names (get_file_date_ranges)
+    '''
+    params      = [1000, 100000]
+    param_names = ['n_files']
+
+    def setup(self, n_files):
+        self.C     = _catalogue_module(tempfile.mkdtemp())
+        self.names = synthetic.file_names(n_files)
+
+    def time_get_file_date_ranges(self, n_files):
+        self.C.get_file_date_ranges(self.names, synthetic.filename_structure)
+
+
+
+class Files:
+    '''
+    Finding the files of catalogue rows (get_files), all of them or those within a period
+    '''
+
+    def setup_cache(self):
+        path = os.path.abspath(os.path.join('files', 'esmcat'))
+        C    = _catalogue_module(path)
+        C._write_parquet(synthetic.make_catalogue(**synthetic.sizes['medium']),
+                            os.path.join(path, 'synthetic_catalogue.parquet'))
+
+    def setup(self):
+        self.C = _catalogue_module(os.path.abspath(os.path.join('files', 'esmcat')))
+        with _quiet():
+            cat = self.C.read_parquet(self.C.setup_catalogue_file('synthetic'))
+        cat       = cat[ cat['Experiment'] == 'historical' ]
+        self.rows = [ cat.iloc[i] for i in np.linspace(0, len(cat)-1, 100).astype(int) ]
+
+    def time_get_files(self):
+        for row in self.rows:
+            self.C.get_files(row)
+
+    def time_get_files_dates(self):
+        for row in self.rows:
+            self.C.get_files(row, start_date=19700101, end_date=19991231)
+
+
+
+def timeraw_import_esmcat():
+    '''
+    Time to import esmcat in a new process (see also import_time.py)
+    '''
+    return 'import esmcat'
@@ -0,0 +1,76 @@
+"""
+Check that "import esmcat" stays fast (i.e., that nothing heavy such as pandas,
+pyarrow or xarray is imported, or any file read, until it is first needed)
+
+    python benchmarks/import_time.py            # default budget: 0.1 s
+    python benchmarks/import_time.py 0.05
+
+Exits with status 1 if the median time to import esmcat (in a new Python
+process, excluding the start up of Python itself) is over budget, if any
+of the heavy modules have been imported, or if esmcat.catalogue is not the
+catalogue function once the esmcat.catalogue module has been imported.
+"""
+
+import os, sys, subprocess
+
+### Modules which should not be imported by "import esmcat"
+heavy_modules = ['numpy', 'pandas', 'pyarrow', 'xarray', 'dask', 'netCDF4']
+
+script = """
+import time, sys
+t = time.perf_counter()
+import esmcat
+t = time.perf_counter() - t
+print(t)
+print(' '.join(m for m in %r if m in sys.modules))
+""" % heavy_modules
+
+
+### However esmcat.catalogue is imported, esmcat.catalogue should still be the function
+binding_script = """
+import types
+import esmcat.catalogue
+from esmcat.catalogue import _row_names
+print(type(esmcat.catalogue) is types.FunctionType)
+"""
+
+
+def catalogue_is_function():
+    '''
+    Is esmcat.catalogue the function (not the module) after importing esmcat.catalogue?
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env  = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    out  = subprocess.run([sys.executable, '-c', binding_script], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return out.strip() == 'True'
+
+
+def import_time(n_repeats=7):
+    '''
+    Median time to import esmcat, and any heavy modules imported with it
+    '''
+    root  = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env   = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = []
+    for i in range(n_repeats):
+        out = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                                capture_output=True, text=True).stdout.split('\n')
+        times.append(float(out[0]))
+        imported = out[1].split()
+    return sorted(times)[len(times)//2], imported
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    t, imported = import_time()
+    print('import esmcat: %.1f ms (budget %.1f ms)' % (t*1000, budget*1000))
+    if len(imported) > 0:
+        print('FAILED: import esmcat imports ' + ', '.join(imported))
+        sys.exit(1)
+    if t > budget:
+        print('FAILED: import esmcat is over budget')
+        sys.exit(1)
+    if not catalogue_is_function():
+        print('FAILED: esmcat.catalogue is the module (not the function) after importing esmcat.catalogue')
+        sys.exit(1)
@@ -0,0 +1,132 @@
+"""
+Synthetic CMIP6-like archives and catalogues for the benchmarks (and for profiling)
+
+    python benchmarks/synthetic.py /tmp/synthetic small     # or medium, large
+
+writes a DRS directory tree of (empty) data files to /tmp/synthetic/archive and
+mip-to-moles style scan files describing it to /tmp/synthetic/scans.
+The dataset dictionaries to use with them are given by dataset_dictionaries().
+"""
+
+import os, sys, json
+import numpy as np
+
+### Size of archive: number of models, runs of each model and variables of each run
+### (directories = 2 MIPs * 2 experiments * 2 CMOR tables * models * runs * vars)
+sizes = {'small':  dict(n_models=4,  n_runs=3,  n_vars=6),
+         'medium': dict(n_models=10, n_runs=5,  n_vars=10),
+         'large':  dict(n_models=30, n_runs=10, n_vars=20),
+         'huge':   dict(n_models=100, n_runs=30, n_vars=20)}     # for make_catalogue only
+
+dir_structure      = 'MIP/Centre/Model/Experiment/RunID/CMOR/Var/Grid/Version'
+filename_structure = 'Var_CMOR_Model_Experiment_RunID_Grid_StartDate-EndDate'
+
+experiments = {'CMIP':['historical', 'piControl'], 'ScenarioMIP':['ssp245', 'ssp585']}
+periods     = {'historical':(1850, 2014), 'piControl':(1850, 2349), 'ssp245':(2015, 2100), 'ssp585':(2015, 2100)}
+cmor_tables = {'Amon':(50, 'mon'), 'day':(10, 'day')}     # (years per file, frequency)
+variables   = ['tas', 'pr', 'psl', 'uas', 'vas', 'huss', 'rsds', 'rlds', 'tasmax', 'tasmin',
+               'ua', 'va', 'ta', 'hus', 'zg', 'clt', 'sfcWind', 'evspsbl', 'prsn', 'ts']
+
+
+
+def dataset_dictionaries(path):
+    '''
+    Dataset dictionaries (as in datasets.json) for the synthetic archive in path:
+    'synthetic' is built by walking the archive, 'synthetic_scans' from the scan files
+    '''
+    walk = {'Root':              os.path.join(path, 'archive'),
+            'DirStructure':      dir_structure,
+            'FilenameStructure': filename_structure,
+            'InclExtensions':    ['.nc'],
+            'Cached':            {}}
+    return {'synthetic':       walk,
+            'synthetic_scans': dict(walk, ScanDir=os.path.join(path, 'scans'))}
+
+
+def runs(n_models, n_runs, n_vars, seed=0):
+    '''
+    DRS parts (a list of directory names) and file names of each data directory.
+    About 1 in 10 variables is missing from each run, as in a real archive
+    '''
+    rng = np.random.default_rng(seed)
+    for mip, exps in experiments.items():
+        for m in range(n_models):
+            model, centre = 'Model-'+str(m), 'Centre-'+str(m % 5)
+            for exp in exps:
+                first, last = periods[exp]
+                for r in range(n_runs):
+                    run_id  = 'r'+str(r+1)+'i1p1f1'
+                    version = 'v2019%02d%02d' % (rng.integers(1, 13), rng.integers(1, 29))
+                    for cmor, (years, freq) in cmor_tables.items():
+                        for var in variables[:n_vars]:
+                            if rng.random() < 0.1: continue
+                            parts   = [mip, centre, model, exp, run_id, cmor, var, 'gn', version]
+                            fnames  = []
+                            for start in range(first, last+1, years):
+                                end = min(start+years-1, last)
+                                if freq == 'mon':
+                                    dates = '%d01-%d12' % (start, end)
+                                else:
+                                    dates = '%d0101-%d1231' % (start, end)
+                                fnames.append('_'.join([var, cmor, model, exp, run_id, 'gn', dates])+'.nc')
+                            yield parts, fnames
+
+
+def make_archive(path, n_models=4, n_runs=3, n_vars=6, seed=0):
+    '''
+    Write a synthetic archive (a DRS tree of empty data files) to path/archive and
+    scan files describing it (one for each MIP and model, named as mip-to-moles
+    names them, e.g., scan0001.CMIP.json) to path/scans
+    Returns the number of data directories
+    '''
+    root, scan_dir = os.path.join(path, 'archive'), os.path.join(path, 'scans')
+    os.makedirs(scan_dir, exist_ok=True)
+
+    scans = {}
+    for parts, fnames in runs(n_models, n_runs, n_vars, seed):
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        for fname in fnames:
+            open(os.path.join(directory, fname), 'w').close()
+        scans.setdefault((parts[0], parts[2]), []).append({'drs_id':'.'.join(['CMIP6']+parts), 'directory':directory})
+
+    for i, ((mip, model), datasets) in enumerate(sorted(scans.items())):
+        with open(os.path.join(scan_dir, 'scan%04d.%s.json' % (i, mip)), 'w') as f:
+            json.dump({'drs_datasets':datasets}, f)
+    return sum(len(d) for d in scans.values())
+
+
+def make_catalogue(n_models=4, n_runs=3, n_vars=6, seed=0, dataset='synthetic'):
+    '''
+    A catalogue (as read by esmcat.catalogue) of a synthetic archive, without writing
+    the archive itself, e.g. for benchmarking queries of large catalogues
+    '''
+    import pandas as pd
+    columns = dir_structure.split('/')
+    rows    = []
+    for parts, fnames in runs(n_models, n_runs, n_vars, seed):
+        dates = [ f.split('_')[-1][:-3].split('-') for f in fnames ]
+        rows.append(parts + [int(dates[0][0]), int(dates[-1][1]), '/'+'/'.join(parts), ';'.join(fnames)])
+    df = pd.DataFrame(rows, columns=columns + ['StartDate', 'EndDate', 'Path', 'DataFiles'])
+    df['dataset'] = dataset
+    return df.astype({'dataset':'category'})
+
+
+def file_names(n, seed=0):
+    '''
+    n file names of the synthetic archive (repeated if needed), e.g. for benchmarking date parsing
+    '''
+    names = []
+    for parts, fnames in runs(**sizes['large'], seed=seed):
+        names.extend(fnames)
+        if len(names) >= n: break
+    return (names * (n // len(names) + 1))[:n]
+
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    size = sys.argv[2] if len(sys.argv) > 2 else 'small'
+    n    = make_archive(path, **sizes[size])
+    print('Written '+str(n)+' data directories to '+os.path.join(path, 'archive'))
+    print(json.dumps(dataset_dictionaries(path), indent=4))
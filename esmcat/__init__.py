@@ -13,15 +13,13 @@ Contributors: Tom Bracegirdle, Tony Phillips
 
 """
 
-import os, json as _json
+import os, sys as _sys, types as _types, json as _json
 
 ### ESMcat version number
 __version__ = "1.9"
 
-### Place to store catalogues and example data
+### Place to store catalogues and example data (created when first needed)
 __esmcat_path = os.path.expanduser("~/.esmcat")
-if not os.path.exists(__esmcat_path):
-    os.makedirs(os.path.expanduser(__esmcat_path))
 
 
 ###############
@@ -36,34 +34,199 @@ def get_config():
             return _json.load(_f)
     return {}
 
-def set_config(machine):
+def set_config(machine=None, **kwargs):
     """
     Set the machine name in ~/.esmcat/config.json.
     esmcat will load datasets_{machine}.json from the package directory.
     e.g. ecat.set_config('jasmin')
+
+    Other settings can be stored in the same way, e.g. the number of threads
+    used when walking the archive to rebuild a catalogue
+    e.g. ecat.set_config(max_workers=32)
     """
+    if not os.path.exists(__esmcat_path):
+        os.makedirs(__esmcat_path)
     config_file = os.path.join(__esmcat_path, 'config.json')
     config = get_config()
-    config['machine'] = machine
+    if machine is not None:
+        config['machine'] = machine
+    config.update(kwargs)
     with open(config_file, 'w') as _f:
         _json.dump(config, _f, indent=4)
-    print("Config saved: machine='" + machine + "'")
-    print("Restart Python for the change to take effect.")
+    if machine is not None:
+        print("Config saved: machine='" + machine + "'")
+        print("Restart Python for the change to take effect.")
+    for key, value in kwargs.items():
+        print("Config saved: " + key + "=" + repr(value))
 
 
-from . import catalogue as _catalogue_module
-catalogue = _catalogue_module.catalogue
-get_files = _catalogue_module.get_files
+###############
+### Lazy imports
+###############
 
-try:
-    import xarray as _xr
-except ImportError:
-    _xr = None
+### Nothing below is imported (e.g., pandas, pyarrow and xarray) or read (the datasets
+### json file) until it is first used, so that "import esmcat" is fast
+_catalogue_names = ['catalogue', 'Catalogue', 'get_files', 'add_file_columns', 'get_file_table',
+                    'catalogue_cache_info', 'clear_catalogue_cache']
+
+def __getattr__(name):
+    if name in _catalogue_names:
+        import importlib
+        importlib.import_module('.catalogue', __name__)
+        return globals()[name]
+    raise AttributeError("module 'esmcat' has no attribute '"+name+"'")
+
+
+class _EsmcatModule(_types.ModuleType):
+    '''
+    However esmcat.catalogue is first imported (e.g., "from esmcat.catalogue import ..."),
+    Python then sets esmcat.catalogue to the module. Bind the functions instead, so
+    that esmcat.catalogue (and the other names above) is always the function
+    '''
+    def __setattr__(self, name, value):
+        if (name == 'catalogue') and isinstance(value, _types.ModuleType):
+            for _name in _catalogue_names:
+                super().__setattr__(_name, getattr(value, _name))
+            return
+        super().__setattr__(name, value)
+
+_sys.modules[__name__].__class__ = _EsmcatModule
+
+def __dir__():
+    return sorted(list(globals().keys()) + _catalogue_names)
 
-if _xr is not None:
-    def open_dataset(df):
-        files = get_files(df)
-        if len(files) == 1:
-            return _xr.open_dataset(files[0])
-        return _xr.open_mfdataset(files)
 
+def open_dataset(df, start_date=None, end_date=None, parallel=False, time_index=None, region=None, time=None):
+    """
+    Open the files of a single row of the catalogue with xarray
+    e.g. ds = ecat.open_dataset(catlg.iloc[0])
+    start_date, end_date: only open the files with data between these dates (YYYYMMDD)
+    e.g. ds = ecat.open_dataset(catlg.iloc[0], start_date=19700101, end_date=19991231)
+    parallel = True: read the headers of multiple files in parallel (with dask)
+    time_index = True: combine multiple files using the index of their time coordinates
+    (~/.esmcat/time_index, written the first time the files are opened) rather than reading
+    every file's header, data is then only read from the files needed when it is used
+    (default: esmcat.set_config(time_index=True) or False)
+    region: only open this region, e.g. {'lat_bnds':[30,70], 'lon_bnds':[-20,40]}
+    time:   only open this period, e.g. slice('1970-01-01', '1999-12-31')
+    Only the files covering time are opened, and the region and time are selected
+    from each file as it is opened, so no more than these are ever read
+    e.g. ds = ecat.open_dataset(catlg.iloc[0], region=bounds, time=slice('1970', '1999'))
+    """
+    import functools
+    import xarray as _xr
+    from esmcat import get_files
+    from esmcat.util import subset
+    if time is not None:
+        if start_date is None: start_date = time.start
+        if end_date is None:   end_date   = time.stop
+    files = get_files(df, start_date=start_date, end_date=end_date)
+    if len(files) == 1:
+        return subset(_xr.open_dataset(files[0]), region=region, time=time)
+    from esmcat.time_index import _get_time_index, open_indexed_dataset
+    if time_index is None:
+        time_index = _get_time_index()
+    if time_index:
+        ds = open_indexed_dataset(files)
+        if ds is not None: return subset(ds, region=region, time=time)
+    if (region is None) and (time is None):
+        return _xr.open_mfdataset(files, parallel=parallel)
+    return _xr.open_mfdataset(files, parallel=parallel,
+                              preprocess=functools.partial(subset, region=region, time=time))
+
+
+def open_datasets(df, max_workers=None, start_date=None, end_date=None, region=None, time=None):
+    """
+    Open each row of the catalogue with xarray (see open_dataset), opening the rows
+    concurrently in a pool of max_workers threads (default: esmcat.set_config(max_workers=N) or 16)
+    Returns two dictionaries keyed by the name of each row (its run and Var):
+    the datasets opened and the errors for rows which could not be opened
+    e.g. datasets, errors = ecat.open_datasets(catlg)
+    region, time: only open this region and period of each row (see open_dataset)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from esmcat.catalogue import _row_names, _get_max_workers
+
+    if max_workers is None:
+        max_workers = _get_max_workers()
+    names = _row_names(df)
+
+    def open_row(i):
+        try:
+            return open_dataset(df.iloc[i], start_date=start_date, end_date=end_date, parallel=True,
+                                region=region, time=time), None
+        except Exception as err:
+            return None, err
+
+    datasets, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names)))) as pool:
+        for name, (ds, err) in zip(names, pool.map(open_row, range(len(names)))):
+            if err is None:
+                datasets[name] = ds
+            else:
+                errors[name] = err
+
+    if len(errors) > 0:
+        print('Could not open '+str(len(errors))+' of '+str(len(names))+' rows:')
+        for name, err in errors.items():
+            print('   '+name+': '+repr(err))
+    return datasets, errors
+
+
+def open_ensemble(df, dim='member', max_workers=None, join='inner', errors='skip', **kwargs):
+    """
+    Open all rows of the catalogue (e.g., every Model and RunID for one Var, CMOR and
+    Experiment) as one Dataset, stacked along dimension dim. The rows are opened
+    concurrently (see open_datasets) and no data is read until it is used
+    e.g. ds = ecat.open_ensemble(catlg, time=slice('1970', '1999'))
+    Each member is labelled by the columns which differ between rows (e.g., Model and RunID),
+    these are also added as coordinates along dim.
+    join: how to align the members on time (and other coordinates), see xarray.align
+    errors = 'skip': leave out rows which can not be opened, 'raise': raise the first error
+    kwargs: passed to open_dataset (e.g., start_date, end_date, region, time)
+    """
+    import numpy as _np
+    import xarray as _xr
+    from esmcat.catalogue import _row_names, _member_columns
+
+    datasets, failed = open_datasets(df, max_workers=max_workers, **kwargs)
+    if (errors == 'raise') and (len(failed) > 0):
+        raise list(failed.values())[0]
+
+    columns = _member_columns(df)
+    names   = _row_names(df)
+    rows    = [ i for i, name in enumerate(names) if name in datasets ]
+    members = [ datasets[names[i]] for i in rows ]
+    if len(members) == 0:
+        raise ValueError('None of the rows could be opened')
+    labels  = [ '_'.join(str(df[c].iloc[i]) for c in columns) if columns else str(df.index[i]) for i in rows ]
+    if len(set(labels)) < len(labels):
+        labels = [ l+'_'+str(df.index[i]) for l, i in zip(labels, rows) ]
+
+    ### Members need the same grid, and times of the same kind (calendars can not be mixed)
+    first = members[0]
+    for label, ds in zip(labels, members):
+        for c in [ c for c in first.indexes if (c != 'time') and (c in ds.indexes) ]:
+            if (ds[c].shape != first[c].shape) or \
+                    ((ds[c].dtype.kind == 'f') and not _np.allclose(ds[c].values, first[c].values)):
+                raise ValueError('The '+c+' coordinate of '+label+' differs from that of '+labels[0]+
+                                    ', the members need to be on the same grid (try regridding them first)')
+        if ('time' in ds.indexes) and ('time' in first.indexes) and \
+                (type(ds.indexes['time']) != type(first.indexes['time'])):
+            raise ValueError('The calendar of '+label+' differs from that of '+labels[0]+
+                                ', open members with different calendars separately')
+
+    ### Dask arrays (rather than arrays read when first used) so concatenating them reads no data
+    members = [ ds if ds.chunks else ds.chunk() for ds in members ]
+    for c in first.indexes:
+        if (c != 'time') and (first[c].dtype.kind == 'f'):
+            members = [ ds.assign_coords({c:first[c].values}) for ds in members ]
+
+    ds = _xr.concat(members, dim=dim, join=join, coords='minimal', compat='override', combine_attrs='drop_conflicts')
+    if ('time' in ds.sizes) and (ds.sizes['time'] == 0):
+        raise ValueError('The members have no times in common, e.g. monthly data given mid-month times which '+
+                            'differ between models, try join="override" (if they cover the same period)')
+    ds = ds.assign_coords({dim:labels})
+    for c in columns:
+        ds = ds.assign_coords({c:(dim, [ str(df[c].iloc[i]) for i in rows ])})
+    return ds
@@ -1,5 +1,5 @@
 import numpy as np
-import glob, os
+import glob, os, time, functools, contextlib, threading, collections.abc
 import pandas as pd
 import json as _json
 
@@ -22,23 +22,57 @@ def _load_datasets():
     with open(datasets_file) as _f:
         return _json.load(_f)
 
-_datasets = _load_datasets()
-dataset_dictionaries = _datasets['dataset_dictionaries']
-__default_dataset    = _datasets['default_dataset']
+class _DatasetDictionaries(collections.abc.MutableMapping):
+    '''
+    The dataset dictionaries from the datasets json file, which is only read when first used
+    '''
+
+    def __init__(self):
+        self.data            = None
+        self.default_dataset = None
+
+    def load(self):
+        if self.data is None:
+            datasets             = _load_datasets()
+            self.default_dataset = datasets['default_dataset']
+            self.data            = datasets['dataset_dictionaries']
+        return self.data
+
+    def __getitem__(self, key):     return self.load()[key]
+    def __setitem__(self, key, value): self.load()[key] = value
+    def __delitem__(self, key):     del self.load()[key]
+    def __iter__(self):             return iter(self.load())
+    def __len__(self):              return len(self.load())
+
+dataset_dictionaries = _DatasetDictionaries()
 
 
 ##################
 ### Global values
 ##################
 
-### Setup initial catalogue to be an empty DataFrame
-__cached_cat = []
+### Large columns which are not read into memory when catalogue(lazy=True),
+### these are read for the selected rows when needed (e.g., by get_files)
+__lazy_columns = ['Path', 'DataFiles']
 
-### If CachedExperiments not defined then set to empty dictionary
-__cached_values = {}
+### Files (and their size and modification time) read for each catalogue read lazily
+__lazy_files      = {}
+__lazy_files_lock = threading.Lock()
 
-### Set the currently loaded dataset to equal the default
-__current_dataset = __default_dataset
+### Sizes of files being added to the size cache of a file table (see __file_sizes)
+__file_sizes_lock = threading.Lock()
+
+### Lock for each dataset held while its file table is written (see __setup_file_table)
+__file_table_locks = {}
+
+### Column of partitioned catalogues holding the position of each row in the catalogue
+### file (see write_partitions), and the version of this layout
+__row_column        = '_CatalogueRow'
+__partition_version = 2
+
+### Version of the dates read from file headers (see esmcat.time_index.header_dates),
+### update this if they change so that cached dates are read again
+__header_dates_version = 2
 
 ### This is used to ensure the catalogue files are compatible 
 ### with this version of the code. Update this number if any changes are
@@ -46,6 +80,26 @@ __current_dataset = __default_dataset
 ### the file to be updated
 __catalogue_version = 20190816
 
+### Number of threads used when walking the archive (can be changed with
+### esmcat.set_config(max_workers=N))
+__default_max_workers = 16
+
+### Number of processes used to parse scan files (1: parse them in this process,
+### change with esmcat.set_config(max_processes=N))
+__default_max_processes = 1
+
+### Memory (MB) used to hold catalogues read for each dataset (change with
+### esmcat.set_config(cache_size_mb=N)), once exceeded the least recently used are dropped
+__default_cache_size_mb = 2000
+
+### Memory (MB) used to hold the rows selected by previous queries, for each catalogue
+### held in memory (change with esmcat.set_config(result_cache_mb=N))
+__default_result_cache_mb = 100
+
+### Number of catalogue rows held in memory (and written as one parquet row
+### group) while building a catalogue (change with esmcat.set_config(row_group_size=N))
+__default_row_group_size = 50000
+
 
 
 
@@ -53,6 +107,62 @@ __catalogue_version = 20190816
 ### Definitions
 ##################
 
+def _get_max_workers():
+    '''
+    Number of threads to use for file system work
+    '''
+    from esmcat import get_config
+    return int(get_config().get('max_workers', __default_max_workers))
+
+
+def _get_max_processes():
+    '''
+    Number of processes to use for CPU bound work when building catalogues
+    '''
+    from esmcat import get_config
+    return int(get_config().get('max_processes', __default_max_processes))
+
+
+def _get_lazy():
+    '''
+    Should catalogues be read without the Path and DataFiles columns by default?
+    '''
+    from esmcat import get_config
+    return bool(get_config().get('lazy', False))
+
+
+def _get_arrow_cache():
+    '''
+    Should catalogues be read from memory mapped Arrow copies of the catalogue files?
+    '''
+    from esmcat import get_config
+    return bool(get_config().get('arrow_cache', False))
+
+
+def _get_cache_size_mb():
+    '''
+    Memory (MB) available for catalogues held in memory
+    '''
+    from esmcat import get_config
+    return float(get_config().get('cache_size_mb', __default_cache_size_mb))
+
+
+def _get_result_cache_mb():
+    '''
+    Memory (MB) available for the results of previous queries of each catalogue
+    '''
+    from esmcat import get_config
+    return float(get_config().get('result_cache_mb', __default_result_cache_mb))
+
+
+def _get_row_group_size():
+    '''
+    Number of rows to buffer before writing them when building catalogues
+    '''
+    from esmcat import get_config
+    return int(get_config().get('row_group_size', __default_row_group_size))
+
+
 def setup_catalogue_file(dataset):
     '''
     Define locations of catalogue files
@@ -97,216 +207,1530 @@ def _write_parquet(df, fname):
     pq.write_table(table.replace_schema_metadata(meta), fname)
 
 
-def write_parquet(df, fname, **kwargs):
-    df = df.copy()
-    if 'root' in kwargs:
-        df['Path'] = df['Path'].map(lambda x: x.replace(kwargs['root'], ''))
-    if 'dataset' in kwargs:
-        df['dataset'] = kwargs['dataset']
-        df = df.astype({'dataset': 'category'})
-    _write_parquet(df, fname)
+def write_parquet(df, fname, **kwargs):
+    df = df.copy()
+    if 'root' in kwargs:
+        df['Path'] = df['Path'].map(lambda x: x.replace(kwargs['root'], ''))
+    if 'dataset' in kwargs:
+        df['dataset'] = kwargs['dataset']
+        df = df.astype({'dataset': 'category'})
+    _write_parquet(df, fname)
+
+
+class _HashSet(object):
+    '''
+    Set of uint64 row hashes, held as a few sorted numpy arrays (8 bytes
+    per row) which are merged as they grow
+    '''
+
+    def __init__(self):
+        self.levels = []
+
+    def isin(self, hashes):
+        mask = np.zeros(len(hashes), dtype=bool)
+        for level in self.levels:
+            ind   = np.minimum(np.searchsorted(level, hashes), len(level)-1)
+            mask |= (level[ind] == hashes)
+        return mask
+
+    def add(self, hashes):
+        self.levels.append(np.sort(hashes))
+        while (len(self.levels) > 1) and (len(self.levels[-2]) <= 2*len(self.levels[-1])):
+            last = self.levels.pop()
+            self.levels[-1] = np.sort(np.concatenate([self.levels[-1], last]))
+
+
+class _LRUCache(object):
+    '''
+    Catalogues read for each dataset, dropping the least recently used
+    once the memory they use exceeds max_bytes
+    '''
+
+    def __init__(self):
+        import collections
+        self.entries   = collections.OrderedDict()
+        self.mutex     = threading.Lock()
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.mutex:
+            if key not in self.entries: return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, nbytes, max_bytes):
+        with self.mutex:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.nbytes      += nbytes
+            ### Never drop the entry just added (even if on its own it exceeds max_bytes)
+            while (self.nbytes > max_bytes) and (len(self.entries) > 1):
+                old_key, (old_value, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes    -= old_nbytes
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.mutex:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+
+    def count(self, hit):
+        with self.mutex:
+            if hit: self.hits   += 1
+            else:   self.misses += 1
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def values(self):
+        with self.mutex:
+            return [ value for value, nbytes in self.entries.values() ]
+
+    def info(self):
+        with self.mutex:
+            return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                    'bytes':self.nbytes, 'entries':[ '_'.join(str(k) for k in key) for key in self.entries ]}
+
+
+def _write_parquet_stream(tables, fname, schema, key_columns, dataset, root, row_group_size=None):
+    '''
+    Write a catalogue while its rows are being produced (tables: an iterable
+    of Arrow tables/batches with the given schema, e.g. one per scan file), buffering at most
+    row_group_size rows before writing them out as a parquet row group.
+    At most row_group_size rows are therefore held at a time, although a hash
+    is kept for every row written: duplicated rows are dropped by comparing
+    hashes of the key_columns with those of all rows written so far.
+    Returns the number of rows written
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if row_group_size is None:
+        row_group_size = _get_row_group_size()
+
+    seen   = _HashSet()
+    buffer = []
+    n_rows = 0
+
+    def flush(buffer):
+        table = pa.concat_tables(buffer)
+        table = table.set_column(table.schema.get_field_index('Path'), 'Path',
+                                    pc.replace_substring(table['Path'], root, ''))
+
+        ### Drop rows seen before (within this row group or in earlier ones)
+        keys   = pd.util.hash_pandas_object(table.select(key_columns).to_pandas(), index=False).to_numpy()
+        unique = np.zeros(len(keys), dtype=bool)
+        unique[np.unique(keys, return_index=True)[1]] = True
+        unique &= ~seen.isin(keys)
+        seen.add(keys[unique])
+        table = table.filter(pa.array(unique))
+
+        codes = pa.array(np.zeros(table.num_rows, dtype=np.int32))
+        return table.append_column('dataset', pa.DictionaryArray.from_arrays(codes, pa.array([dataset])))
+
+    tmp_file = fname + '.tmp'
+    out_schema = schema.append(pa.field('dataset', pa.dictionary(pa.int32(), pa.string())))
+    out_schema = out_schema.with_metadata({b'catalogue_version': str(__catalogue_version).encode()})
+    writer = pq.ParquetWriter(tmp_file, out_schema)
+    try:
+        for table in tables:
+            if isinstance(table, pa.RecordBatch):
+                table = pa.Table.from_batches([table])
+            buffer.append(table.cast(schema))
+            if sum(t.num_rows for t in buffer) >= row_group_size:
+                table   = flush(buffer)
+                n_rows += table.num_rows
+                writer.write_table(table, row_group_size=row_group_size)
+                buffer  = []
+        if len(buffer) > 0:
+            table   = flush(buffer)
+            n_rows += table.num_rows
+            writer.write_table(table, row_group_size=row_group_size)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_file)
+        raise
+
+    writer.close()
+    os.replace(tmp_file, fname)
+    return n_rows
+
+
+def _filter_expression(schema, filters):
+    '''
+    Translate a dictionary of filters (e.g., {'Var':['tas','pr'], 'CMOR':'Amon'})
+    into a pyarrow expression, so that filtering happens while reading the
+    file and row groups without matching rows are skipped. Keys which are
+    not columns, or values which do not match the column's type, are left
+    to be filtered in pandas.
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    expr = None
+    for key, vals in filters.items():
+        if key not in schema.names: continue
+        if (vals.__class__ == str) | (vals.__class__ == np.bytes_): vals = [vals]
+        col_type = schema.field(key).type
+        if pa.types.is_dictionary(col_type): col_type = col_type.value_type
+        try:
+            vals = pa.array(list(vals), col_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            continue
+        expr = ds.field(key).isin(vals) if expr is None else expr & ds.field(key).isin(vals)
+    return expr
+
+
+def read_parquet(fname, filters=None, lazy=False, partitions=None, arrow_cache=False):
+    '''
+    Read a catalogue file. filters (a dictionary, e.g., {'Var':['tas','pr']})
+    are pushed down to pyarrow, so only the matching rows are decoded.
+    lazy = True: do not read the (large) Path and DataFiles columns, instead add
+    a RowKey column (giving the row's position within the file) which can be used to
+    read them later for just the rows needed (see add_file_columns)
+    partitions: directory of the partitioned copy of fname (see write_partitions),
+    only the partitions matching filters are read
+    arrow_cache = True: read from a memory mapped Arrow copy of fname (see write_arrow_cache)
+    '''
+    import pyarrow.parquet as pq
+    schema       = pq.read_schema(fname)
+    meta         = schema.metadata or {}
+    file_version = int(meta.get(b'catalogue_version', b'0'))
+    if __catalogue_version > file_version:
+        raise ValueError('Your catalogue needs to be updated to work with this version of the code')
+    if arrow_cache:
+        df = __read_arrow_table(fname, schema, filters, lazy)
+        print('catalogue memory usage (MB):', df.memory_usage().sum() * 0.000001)
+        return df
+    if partitions is not None:
+        schema = __partition_schema(schema, __read_partition_stamp(partitions)['PartitionBy'])
+    if lazy:
+        df = __read_parquet_lazy(fname, schema, filters, partitions)
+    elif partitions is not None:
+        table = __partition_dataset(partitions, schema).to_table(
+                    filter=_filter_expression(schema, filters) if filters else None)
+        df = __in_catalogue_order(table).to_pandas()
+    elif filters:
+        import pyarrow.dataset as ds
+        table = ds.dataset(fname, format='parquet').to_table(filter=_filter_expression(schema, filters))
+        df = table.to_pandas()
+    else:
+        df = pd.read_parquet(fname)
+    print('catalogue memory usage (MB):', df.memory_usage().sum() * 0.000001)
+    return df
+
+
+def __arrow_cache_file(fname):
+    return os.path.splitext(fname)[0] + '.arrow'
+
+
+def write_arrow_cache(fname, arrow_file=None, row_group_size=None):
+    '''
+    Write a copy of catalogue file fname in (uncompressed) Arrow IPC format, with the
+    string columns (except Path and DataFiles) dictionary-encoded. This can be memory
+    mapped, so reading it needs no decoding and processes on the same machine share
+    the same pages of memory. The size and modification time of fname are stored
+    so the copy can be ignored once fname has changed
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if arrow_file is None:
+        arrow_file = __arrow_cache_file(fname)
+    if row_group_size is None:
+        row_group_size = _get_row_group_size()
+
+    pf     = pq.ParquetFile(fname)
+    schema = pf.schema_arrow
+
+    ### Find all values of each column to be encoded (dictionaries can not change
+    ### between batches in an IPC file) then write out one batch at a time
+    encode = [ f.name for f in schema if (f.name not in __lazy_columns) and
+                (pa.types.is_string(f.type) or (pa.types.is_dictionary(f.type) and pa.types.is_string(f.type.value_type))) ]
+    values = { c:pc.unique(pf.read(columns=[c]).column(c).cast(pa.string())) for c in encode }
+    for c in encode:
+        schema = schema.set(schema.get_field_index(c), pa.field(c, pa.dictionary(pa.int32(), pa.string())))
+    meta = dict(schema.metadata or {})
+    meta[b'source'] = ' '.join(str(i) for i in __file_id(fname)).encode()
+    schema = schema.with_metadata(meta)
+
+    ### (each writer has its own temporary file, as many processes may write the copy at once)
+    tmp_file = arrow_file+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+    try:
+        with pa.OSFile(tmp_file, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            for batch in pf.iter_batches(batch_size=row_group_size):
+                cols = [ pa.DictionaryArray.from_arrays(pc.index_in(batch.column(c).cast(pa.string()),
+                                                                    value_set=values[c]).cast(pa.int32()),
+                                                        values[c])
+                            if c in encode else batch.column(c) for c in schema.names ]
+                writer.write_batch(pa.RecordBatch.from_arrays(cols, schema=schema))
+    except BaseException:
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+        raise
+    try:
+        os.replace(tmp_file, arrow_file)
+    except OSError:
+        ### Another process has replaced (and may be mapping) the copy, use theirs
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+        if not os.path.isfile(arrow_file): raise
+    return arrow_file
+
+
+def __read_arrow_cache(fname):
+    '''
+    Memory map the Arrow IPC copy of catalogue file fname, (re)writing it if it is
+    missing or out of date
+    '''
+    import pyarrow as pa
+
+    arrow_file = __arrow_cache_file(fname)
+    source     = ' '.join(str(i) for i in __file_id(fname)).encode()
+    if os.path.isfile(arrow_file):
+        reader = pa.ipc.open_file(pa.memory_map(arrow_file, 'r'))
+        meta   = reader.schema.metadata or {}
+        if (meta.get(b'source') == source) and \
+                (int(meta.get(b'catalogue_version', b'0')) == __catalogue_version):
+            return reader.read_all()
+
+    print('Writing Arrow copy of catalogue...')
+    write_arrow_cache(fname, arrow_file)
+    return pa.ipc.open_file(pa.memory_map(arrow_file, 'r')).read_all()
+
+
+def __read_arrow_table(fname, schema, filters, lazy):
+    '''
+    Read a catalogue from its memory mapped Arrow copy, only the rows matching
+    filters are copied (and decoded back to the column types in fname)
+    '''
+    import pyarrow as pa
+
+    table = __read_arrow_cache(fname)
+    if lazy:
+        table = table.select([ c for c in table.schema.names if c not in __lazy_columns ])
+        n     = __lazy_file_index(fname, fname)
+        table = table.append_column('RowKey', pa.array(np.arange(table.num_rows, dtype=np.int64) + (n << 32)))
+    if filters:
+        table = table.filter(_filter_expression(schema, filters))
+    for f in schema:
+        if (f.name in table.schema.names) and (table.schema.field(f.name).type != f.type):
+            table = table.set_column(table.schema.get_field_index(f.name), f.name, table.column(f.name).cast(f.type))
+    return table.to_pandas()
+
+
+def __read_parquet_lazy(fname, schema, filters, partitions=None):
+    '''
+    Read all columns except the lazy columns, one row group at a time, adding
+    RowKey: the index of the file read (see __lazy_file_index) * 2**32 + the
+    position of the row within that file
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = [ c for c in schema.names if c not in __lazy_columns ]
+    expr    = _filter_expression(schema, filters) if filters else None
+
+    ### Files to read and the values of the partition columns in each
+    if partitions is None:
+        files = [ (fname, {}) ]
+    else:
+        import pyarrow.dataset as ds
+        files = [ (f.path, ds.get_partition_keys(f.partition_expression))
+                    for f in __partition_dataset(partitions, schema).get_fragments(filter=expr) ]
+
+    ### (partition files also hold the position of each row in fname)
+    if partitions is not None: columns = columns + [__row_column]
+
+    tables = []
+    for file, keys in files:
+        n      = __lazy_file_index(fname, file)
+        pf     = pq.ParquetFile(file)
+        offset = 0
+        for i in range(pf.num_row_groups):
+            table   = pf.read_row_group(i, columns=[ c for c in columns if c not in keys ])
+            for c in keys: table = table.append_column(c, pa.array([keys[c]]*table.num_rows, pa.string()))
+            table   = table.select(columns)
+            table   = table.append_column('RowKey', pa.array(np.arange(offset, offset+table.num_rows, dtype=np.int64) + (n << 32)))
+            offset += table.num_rows
+            if expr is not None: table = table.filter(expr)
+            tables.append(table)
+
+    if len(tables) == 0:
+        table = __row_schema(schema).empty_table().select(columns).append_column('RowKey', pa.array([], pa.int64()))
+    else:
+        table = pa.concat_tables(tables)
+    if partitions is not None: table = __in_catalogue_order(table)
+    return table.to_pandas()
+
+
+def __file_id(fname):
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def __lazy_file_index(fname, file):
+    '''
+    Index of file (fname or one of its partitions), as it is now, within the
+    files read lazily for catalogue fname. Files are only ever added so that
+    RowKeys in catalogues read earlier continue to refer to the same files
+    '''
+    file_id = (file, __file_id(file))
+    with __lazy_files_lock:
+        files_read = __lazy_files.setdefault(fname, [])
+        if file_id not in files_read: files_read.append(file_id)
+        return files_read.index(file_id)
+
+
+def _read_rows(fname, row_keys, columns):
+    '''
+    Read columns for the rows with row_keys (from a lazy read of catalogue file fname),
+    only the row groups containing these rows are read
+    '''
+    import pyarrow.parquet as pq
+
+    row_keys = np.asarray(row_keys, dtype=np.int64)
+    files    = row_keys >> 32
+    row_keys = row_keys & 0xFFFFFFFF
+
+    df = pd.DataFrame(index=range(len(row_keys)), columns=columns, dtype=object)
+    with __lazy_files_lock:
+        files_read = list(__lazy_files.get(fname, []))
+    for n in np.unique(files):
+        if (n >= len(files_read)) or (not os.path.exists(files_read[n][0])) or \
+                (files_read[n][1] != __file_id(files_read[n][0])):
+            raise ValueError(fname+' has changed since the catalogue was read, please re-run catalogue()')
+
+        pf     = pq.ParquetFile(files_read[n][0])
+        starts = np.cumsum([0] + [ pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups) ])
+        ind    = np.flatnonzero(files == n)
+        groups = np.searchsorted(starts, row_keys[ind], side='right') - 1
+        for i in np.unique(groups):
+            rows  = ind[groups == i]
+            table = pf.read_row_group(int(i), columns=columns).take(row_keys[rows] - starts[i])
+            for c in columns: df.loc[rows, c] = table.column(c).to_numpy(zero_copy_only=False)
+    return df
+
+
+def __partition_schema(schema, partition_by):
+    '''
+    Schema of a partitioned catalogue (partition columns are always strings)
+    '''
+    import pyarrow as pa
+    for key in partition_by:
+        i = schema.get_field_index(key)
+        schema = schema.set(i, pa.field(key, pa.string()))
+    return schema
+
+
+def __row_schema(schema):
+    '''
+    Schema of the partition files: the catalogue's, plus the position of each row in the catalogue file
+    '''
+    import pyarrow as pa
+    return schema.append(pa.field(__row_column, pa.int64()))
+
+
+def __in_catalogue_order(table):
+    '''
+    Rows read from partitions, back in the order of the catalogue file (without the position column)
+    '''
+    return table.sort_by(__row_column).drop_columns([__row_column])
+
+
+def __partition_dataset(partitions, schema):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    partition_by = __read_partition_stamp(partitions)['PartitionBy']
+    partitioning = ds.partitioning(pa.schema([ (key, pa.string()) for key in partition_by ]), flavor='hive')
+    return ds.dataset(partitions, format='parquet', partitioning=partitioning, schema=__row_schema(schema))
+
+
+def __read_partition_stamp(partitions):
+    stamp_file = os.path.join(partitions, '_catalogue.json')
+    if not os.path.isfile(stamp_file): return None
+    with open(stamp_file) as f:
+        return _json.load(f)
+
+
+def __partition_stamp(fname, partition_by):
+    '''
+    Which catalogue file (and version of the layout) the partitions are written from
+    '''
+    return {'Source':list(__file_id(fname)), 'PartitionBy':list(partition_by),
+            'catalogue_version':__catalogue_version, 'partition_version':__partition_version}
+
+
+def write_partitions(fname, partition_by, partitions=None, row_group_size=None):
+    '''
+    Write a copy of catalogue file fname split into directories by the values of
+    the columns partition_by (e.g., ['MIP','Experiment','CMOR'] -> MIP=CMIP/Experiment=historical/CMOR=Amon/)
+    so that reading a filtered catalogue only needs to open the matching partitions.
+    The copy is written to a temporary directory first and only those partition
+    files which have changed are then moved into place. Each row's position in fname
+    is kept, so that rows read from the partitions are in the same order as fname.
+    Returns the directory of the partitioned catalogue
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    import filecmp, shutil
+
+    if partitions is None:
+        partitions = os.path.splitext(fname)[0]
+    if row_group_size is None:
+        row_group_size = _get_row_group_size()
+
+    ### Stream the catalogue file into partitions, one row group at a time
+    schema  = __partition_schema(pq.read_schema(fname), partition_by)
+    pf      = pq.ParquetFile(fname)
+
+    def batches():
+        offset = 0
+        for b in pf.iter_batches(batch_size=row_group_size):
+            b = b.cast(schema).append_column(__row_column,
+                    pa.array(np.arange(offset, offset+b.num_rows, dtype=np.int64)))
+            offset += b.num_rows
+            yield b
+
+    reader  = pa.RecordBatchReader.from_batches(__row_schema(schema), batches())
+    ### (each writer has its own temporary directory, as many processes may write the copy at once)
+    tmp_dir = partitions+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+    if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+    ds.write_dataset(reader, tmp_dir, format='parquet', use_threads=False,
+                     partitioning=ds.partitioning(pa.schema([ (key, pa.string()) for key in partition_by ]), flavor='hive'),
+                     basename_template='part-{i}.parquet', max_rows_per_group=row_group_size,
+                     min_rows_per_group=row_group_size, existing_data_behavior='overwrite_or_ignore',
+                     create_dir=True)
+
+    ### Move changed partitions into place and remove any which no longer exist
+    ### (another process may be doing the same, so files already gone are ignored
+    ### and directories still needed are never removed)
+    new_files = set()
+    new_dirs  = {partitions}
+    n_changed = 0
+    for dirpath, dirnames, filenames in os.walk(tmp_dir):
+        for f in filenames:
+            rel_name = os.path.relpath(os.path.join(dirpath, f), tmp_dir)
+            new_files.add(rel_name)
+            old_file = os.path.join(partitions, rel_name)
+            d = os.path.dirname(old_file)
+            while d not in new_dirs:
+                new_dirs.add(d)
+                d = os.path.dirname(d)
+            if os.path.isfile(old_file) and filecmp.cmp(old_file, os.path.join(dirpath, f), shallow=False):
+                continue
+            os.makedirs(os.path.dirname(old_file), exist_ok=True)
+            os.replace(os.path.join(dirpath, f), old_file)
+            n_changed += 1
+    for dirpath, dirnames, filenames in os.walk(partitions, topdown=False):
+        for f in filenames:
+            rel_name = os.path.relpath(os.path.join(dirpath, f), partitions)
+            if (rel_name not in new_files) & (rel_name != '_catalogue.json'):
+                try:
+                    os.remove(os.path.join(dirpath, f))
+                    n_changed += 1
+                except FileNotFoundError:
+                    pass
+        if dirpath not in new_dirs:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+    shutil.rmtree(tmp_dir)
+
+    ### Record which catalogue file the partitions were written from
+    with open(tmp_dir+'.json', 'w') as f:
+        _json.dump(__partition_stamp(fname, partition_by), f)
+    os.replace(tmp_dir+'.json', os.path.join(partitions, '_catalogue.json'))
+    print('Partitioned catalogue:', len(new_files), 'files,', n_changed, 'changed')
+    return partitions
+
+
+def __setup_partitions(dataset, cat_file):
+    '''
+    Directory of the partitioned catalogue for datasets with PartitionBy defined
+    (None otherwise), (re)writing it if cat_file has been updated
+    '''
+    partition_by = dataset_dictionaries[dataset].get('PartitionBy')
+    if not partition_by: return None
+
+    partitions = os.path.splitext(cat_file)[0]
+    stamp      = __read_partition_stamp(partitions) if os.path.isdir(partitions) else None
+    if stamp != __partition_stamp(cat_file, partition_by):
+        print('Partitioning catalogue by '+'/'.join(partition_by)+'...')
+        write_partitions(cat_file, partition_by, partitions)
+    return partitions
+
+
+def __path_ids(paths):
+    '''
+    Integer id (a 64 bit hash of Path) linking catalogue rows to their files in the file table
+    '''
+    return pd.util.hash_array(np.asarray(paths, dtype=object)).astype(np.int64)
+
+
+def __file_table_file(fname):
+    return os.path.splitext(fname)[0] + '_files.parquet'
+
+
+def __file_table_meta(fname, filename_structure):
+    return {b'source':            ' '.join(str(i) for i in __file_id(fname)).encode(),
+            b'FilenameStructure': filename_structure.encode(),
+            b'catalogue_version': str(__catalogue_version).encode(),
+            b'file_table_version': b'2'}
+
+
+def __file_sizes_file(fname):
+    return os.path.splitext(fname)[0] + '_sizes.parquet'
+
+
+def __stat_sizes(files, max_workers):
+    '''
+    Size (bytes) of each file, -1 for files which can not be found
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def size(f):
+        try:
+            return os.stat(f).st_size
+        except OSError:
+            return -1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return np.fromiter(pool.map(size, files, chunksize=100), dtype=np.int64, count=len(files))
+
+
+def __file_sizes(fname, path_ids, names, files, max_workers=None):
+    '''
+    Size (bytes) of each file of catalogue file fname (-1 if it can not be found),
+    given as (PathID, Name) and full path. Sizes are kept in <dataset>_catalogue_sizes.parquet,
+    so only the files asked for which have not been sized before are looked up (in a
+    pool of max_workers threads), these are then added to it
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    if max_workers is None:
+        max_workers = _get_max_workers()
+
+    sizes_file = __file_sizes_file(fname)
+    files_df   = pd.DataFrame({'PathID':np.asarray(path_ids, dtype=np.int64), 'Name':np.asarray(names, dtype=object)})
+    if os.path.isfile(sizes_file):
+        known = ds.dataset(sizes_file, format='parquet').to_table(
+                    filter=ds.field('PathID').isin(pa.array(np.unique(files_df['PathID'].to_numpy())))).to_pandas()
+        known['Name'] = known['Name'].astype(object)
+        ### (one size per file, even if the cache holds a file more than once)
+        known = known.drop_duplicates(['PathID', 'Name'], keep='last')
+        sizes = files_df.merge(known, on=['PathID', 'Name'], how='left', validate='many_to_one')['Size'] \
+                    .fillna(-1).to_numpy(dtype=np.int64)
+    else:
+        sizes = np.full(len(files_df), -1, dtype=np.int64)
+
+    todo = np.flatnonzero(sizes < 0)
+    if len(todo) == 0: return sizes
+    if len(todo) > 1000: print('Finding the size of '+str(len(todo))+' files...')
+    sizes[todo] = __stat_sizes([ files[i] for i in todo ], max_workers)
+
+    ### Remember the sizes found (files which can not be found are looked up again next time)
+    ### (files asked for more than once, or already added by another caller, are kept once)
+    found = files_df.iloc[todo[sizes[todo] >= 0]].assign(Size=sizes[todo][sizes[todo] >= 0])
+    found = found.drop_duplicates(['PathID', 'Name'])
+    if len(found) > 0:
+        with __file_sizes_lock:
+            if os.path.isfile(sizes_file):
+                old   = pq.read_table(sizes_file).to_pandas()
+                old['Name'] = old['Name'].astype(object)
+                found = pd.concat([old, found], ignore_index=True).drop_duplicates(['PathID', 'Name'], keep='last')
+            found = found.iloc[np.argsort(found['PathID'].to_numpy(), kind='stable')]
+            table = pa.Table.from_pandas(found, preserve_index=False).cast(
+                        pa.schema([('PathID', pa.int64()), ('Name', pa.string()), ('Size', pa.int64())]))
+            tmp_file = sizes_file+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+            pq.write_table(table, tmp_file, row_group_size=_get_row_group_size())
+            os.replace(tmp_file, sizes_file)
+    return sizes
+
+
+def write_file_table(fname, filename_structure, files_file=None, row_group_size=None):
+    '''
+    Write a table of the files of catalogue file fname, with one row per file rather
+    than a DataFiles string per catalogue row: PathID (linking the file to its catalogue
+    row, see get_file_table), Name, StartDate and EndDate (parsed from the file name, null
+    if they can not be identified). The table is sorted by PathID, so reading the files
+    of a few rows only reads the row groups holding them. The sizes of files are not
+    looked up here, only when they are asked for (see __file_sizes)
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if files_file is None:
+        files_file = __file_table_file(fname)
+    if row_group_size is None:
+        row_group_size = _get_row_group_size()
+
+    ### Split the DataFiles of each (distinct) path into one row per file
+    seen   = _HashSet()
+    tables = []
+    for batch in pq.ParquetFile(fname).iter_batches(batch_size=row_group_size, columns=['Path', 'DataFiles']):
+        ids    = __path_ids(batch.column('Path').to_numpy(zero_copy_only=False))
+        unique = np.zeros(len(ids), dtype=bool)
+        unique[np.unique(ids, return_index=True)[1]] = True
+        unique &= ~seen.isin(ids)
+        seen.add(ids[unique])
+
+        names = pc.split_pattern(batch.column('DataFiles').filter(pa.array(unique)), ';')
+        rows  = pc.list_parent_indices(names).to_numpy()
+        names = pc.list_flatten(names)
+        tables.append(pa.table({'PathID':ids[unique][rows], 'Name':names}))
+    table = pa.concat_tables(tables) if tables else \
+                pa.table({'PathID':pa.array([], pa.int64()), 'Name':pa.array([], pa.string())})
+    table = table.take(pa.array(np.lexsort((table.column('Name').to_numpy(zero_copy_only=False),
+                                            table.column('PathID').to_numpy()))))
+
+    start_dates, end_dates, unparsed = get_file_date_ranges_batch(
+                                            table.column('Name').to_numpy(zero_copy_only=False), filename_structure)
+
+    table = pa.table({'PathID':    table.column('PathID'),
+                      'Name':      table.column('Name'),
+                      'StartDate': pa.array(start_dates, pa.int64(), mask=unparsed),
+                      'EndDate':   pa.array(end_dates, pa.int64(), mask=unparsed)})
+    table = table.replace_schema_metadata(__file_table_meta(fname, filename_structure))
+    ### (each writer has its own temporary file, as many processes may write the table at once)
+    tmp_file = files_file+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+    pq.write_table(table, tmp_file, row_group_size=row_group_size)
+    os.replace(tmp_file, files_file)
+    print('File table:', table.num_rows, 'files')
+    return files_file
+
+
+def __setup_file_table(dataset, cat_file):
+    '''
+    File table of catalogue cat_file, (re)writing it if cat_file has been updated.
+    Only one thread writes the table of each dataset, others wait for it
+    '''
+    import pyarrow.parquet as pq
+
+    def is_valid():
+        if not os.path.isfile(files_file): return False
+        file_meta = pq.read_schema(files_file).metadata or {}
+        return all(file_meta.get(key) == value for key, value in meta.items())
+
+    dataset_dict = dataset_dictionaries[dataset]
+    files_file   = __file_table_file(cat_file)
+    meta         = __file_table_meta(cat_file, dataset_dict['FilenameStructure'])
+    if is_valid(): return files_file
+
+    with __file_table_locks.setdefault(dataset, threading.Lock()):
+        ### (another thread may have written it while waiting for the lock)
+        if is_valid(): return files_file
+        print('Writing file table of '+dataset+' catalogue...')
+        return write_file_table(cat_file, dataset_dict['FilenameStructure'], files_file)
+
+
+def _read_csv_legacy(fname, dataset):
+    dataset_dict = dataset_dictionaries[dataset]
+    if 'dtypes' in dataset_dict:
+        df = pd.read_csv(fname, comment='#', dtype=dataset_dict['dtypes'])
+    else:
+        df = pd.read_csv(fname, comment='#')
+    df['dataset'] = dataset
+    return df.astype({'dataset': 'category'})
+
+
+
+def __list_data_dir(directory, InclExtensions):
+    '''
+    Data files within a directory listed in a scan file (None if the directory has gone)
+    '''
+    if not os.path.isdir(directory):
+        return None
+    return [fn for fn in os.listdir(directory)
+              if any(fn.endswith(ext) for ext in InclExtensions)
+              and len(fn.split('.')) == 2]
+
+
+def __rows_from_scan(scan_file, dataset_dict, pool=None):
+    '''
+    Catalogue rows for the datasets within one JSON scan file. The data
+    directories are probed concurrently if a thread pool is given.
+    '''
+    import json as _json
+
+    with open(scan_file) as f:
+        scan = _json.load(f)
+
+    datasets    = scan.get('drs_datasets', [])
+    directories = [ds['directory'] for ds in datasets]
+    incl_exts   = [dataset_dict['InclExtensions']] * len(directories)
+    if pool is None:
+        listings = map(__list_data_dir, directories, incl_exts)
+    else:
+        listings = pool.map(__list_data_dir, directories, incl_exts)
+
+    dirs = []
+    for ds, directory, fnames in zip(datasets, directories, listings):
+
+        if not fnames:
+            continue
+
+        # Parse column values from drs_id, skipping the leading 'CMIP6' token
+        # e.g. CMIP6.AerChemMIP.BCC.BCC-ESM1.hist-piNTCF.r1i1p1f1.Amon.ch4.gn.v20190621
+        parts = ds['drs_id'].split('.')[1:]
+
+        dirs.append((parts, directory, fnames))
+
+    return __dirs_to_rows(dirs, dataset_dict['FilenameStructure'])
+
+
+def __dirs_to_rows(dirs, filename_structure):
+    '''
+    Catalogue rows for data directories given as (parts, path, fnames). The
+    dates of all files are parsed at once, then reduced to the first start
+    date and last end date of each directory. Directories where none of the
+    dates could be identified are given dates of -1, these are then read from
+    the file headers (see __header_dates_stage)
+    '''
+    dirs = [d for d in dirs if len(d[2]) > 0]
+    if len(dirs) == 0:
+        return []
+
+    fnames = [fn for parts, path, fns in dirs for fn in fns]
+    start_dates, end_dates, unparsed = get_file_date_ranges_batch(fnames, filename_structure)
+    for i in np.flatnonzero(unparsed):
+        print('Cannot identify dates '+os.path.splitext(fnames[i])[0])
+
+    offsets     = np.cumsum([0] + [len(d[2]) for d in dirs[:-1]])
+    first_start = np.minimum.reduceat(np.where(unparsed, np.iinfo(np.int64).max, start_dates), offsets)
+    last_end    = np.maximum.reduceat(np.where(unparsed, np.iinfo(np.int64).min, end_dates), offsets)
+    n_dated     = np.add.reduceat(~unparsed, offsets)
+
+    rows = []
+    for (parts, path, fns), start, end, n in zip(dirs, first_start, last_end, n_dated):
+        if n == 0: start, end = -1, -1
+        rows.append(list(parts) + [int(start), int(end), path, ';'.join(fns)])
+    return rows
+
+
+def __read_header_dates(cache_file):
+    '''
+    Dates read from file headers by earlier builds: {file: (mtime, start, end)}
+    '''
+    import pyarrow.parquet as pq
+    if not os.path.isfile(cache_file): return {}
+    table = pq.read_table(cache_file)
+    ### (dates read by an earlier version of header_dates are read again)
+    if (table.schema.metadata or {}).get(b'header_dates_version') != str(__header_dates_version).encode():
+        return {}
+    return dict(zip(table['File'].to_pylist(), zip(table['MTime'].to_pylist(), table['StartDate'].to_pylist(),
+                                                    table['EndDate'].to_pylist())))
+
+
+def __write_header_dates(cache_file, cache):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    files = list(cache.keys())
+    table = pa.table({'File':      pa.array(files, pa.string()),
+                      'MTime':     pa.array([ cache[f][0] for f in files ], pa.int64()),
+                      'StartDate': pa.array([ cache[f][1] for f in files ], pa.int64()),
+                      'EndDate':   pa.array([ cache[f][2] for f in files ], pa.int64())})
+    table = table.replace_schema_metadata({b'header_dates_version':str(__header_dates_version).encode()})
+    tmp_file = cache_file+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+
+def __file_header_dates(file, cache):
+    '''
+    (mtime, start, end) of file, from cache if the file has not been modified since
+    '''
+    from esmcat.time_index import header_dates
+    try:
+        mtime = os.stat(file).st_mtime_ns
+    except OSError:
+        return None, None, None
+    if (file in cache) and (cache[file][0] == mtime):
+        return cache[file]
+    return (mtime,) + tuple(header_dates(file))
+
+
+def __header_dates_stage(tables, dataset, max_workers):
+    '''
+    Fill in the dates of rows (directories) where none of the file names gave dates
+    (StartDate = -1, see __dirs_to_rows) by reading the time variable of their files,
+    in a pool of max_workers threads. Dates are cached by file path and mtime (in
+    ~/.esmcat/<dataset>_header_dates.parquet) so later builds do not read them again.
+    Rows where no dates can be found are dropped
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from concurrent.futures import ThreadPoolExecutor
+    from esmcat import __esmcat_path
+
+    cache_file = os.path.join(__esmcat_path, dataset + '_header_dates.parquet')
+    cache      = None
+    n_read     = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for table in tables:
+            if isinstance(table, pa.RecordBatch):
+                table = pa.Table.from_batches([table])
+            undated = pc.equal(table['StartDate'], -1).to_numpy(zero_copy_only=False)
+            if not undated.any():
+                yield table
+                continue
+
+            if cache is None:
+                cache = __read_header_dates(cache_file)
+            rows    = np.flatnonzero(undated)
+            paths   = table['Path'].take(pa.array(rows)).to_pylist()
+            names   = [ fns.split(';') for fns in table['DataFiles'].take(pa.array(rows)).to_pylist() ]
+            files   = [ os.path.join(p, n) for p, fns in zip(paths, names) for n in fns ]
+            results = list(pool.map(__file_header_dates, files, [cache]*len(files)))
+            n_read += sum((f not in cache) or (cache[f] != r) for f, r in zip(files, results))
+            for f, r in zip(files, results):
+                if r[0] is not None: cache[f] = r
+
+            ### First start date and last end date of each directory
+            starts = np.array([ np.nan if r[1] is None else r[1] for r in results ], dtype=float)
+            ends   = np.array([ np.nan if r[2] is None else r[2] for r in results ], dtype=float)
+            offsets = np.cumsum([0] + [ len(fns) for fns in names[:-1] ])
+            with np.errstate(invalid='ignore'):
+                first_start = np.fmin.reduceat(starts, offsets)
+                last_end    = np.fmax.reduceat(ends, offsets)
+
+            start_dates = table['StartDate'].to_numpy().copy()
+            end_dates   = table['EndDate'].to_numpy().copy()
+            start_dates[rows] = np.where(np.isnan(first_start), -1, first_start)
+            end_dates[rows]   = np.where(np.isnan(last_end), -1, last_end)
+            for p, s in zip(paths, first_start):
+                if np.isnan(s): print('Cannot identify dates from file names or headers in '+p)
+
+            table = table.set_column(table.schema.get_field_index('StartDate'), 'StartDate', pa.array(start_dates))
+            table = table.set_column(table.schema.get_field_index('EndDate'), 'EndDate', pa.array(end_dates))
+            yield table.filter(pa.array(start_dates != -1))
+
+    if n_read > 0:
+        print('Read dates from the headers of '+str(n_read)+' files')
+        __write_header_dates(cache_file, cache)
+
+
+def __scan_schema(columns):
+    import pyarrow as pa
+    return pa.schema([(c, pa.int64() if c in ('StartDate', 'EndDate') else pa.string())
+                        for c in columns])
+
+
+def __scan_to_batch(scan_file, dataset_dict, columns, max_workers):
+    '''
+    Process pool worker: parse one scan file, probing its data directories
+    in a thread pool, and return the rows as a column-oriented Arrow batch
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = __rows_from_scan(scan_file, dataset_dict, pool)
+
+    return __rows_to_batch(rows, columns)
+
+
+def __rows_to_batch(rows, columns):
+    '''
+    Convert rows to a column-oriented Arrow batch
+    '''
+    import pyarrow as pa
+    schema = __scan_schema(columns)
+    cols   = list(zip(*rows)) if rows else [[]]*len(schema)
+    return pa.RecordBatch.from_arrays([pa.array(col, f.type) for col, f in zip(cols, schema)],
+                                        schema=schema)
+
+
+def __fragment_name(scan_file):
+    '''
+    Name of the cached fragment for a scan file, keyed by its size and mtime
+    '''
+    st = os.stat(scan_file)
+    return os.path.basename(scan_file) + '.' + str(st.st_size) + '-' + str(st.st_mtime_ns) + '.parquet'
+
+
+def __fragment_meta(dataset_dict):
+    '''
+    Settings the rows of a fragment depend on. Fragments written with
+    other settings (or an older catalogue version) are not reused
+    '''
+    return {b'catalogue_version': str(__catalogue_version).encode(),
+            b'UndatedRows':       b'1',
+            b'DirStructure':      dataset_dict['DirStructure'].encode(),
+            b'FilenameStructure': dataset_dict['FilenameStructure'].encode(),
+            b'InclExtensions':    ';'.join(dataset_dict['InclExtensions']).encode()}
+
+
+def __fragment_is_valid(fragment_file, dataset_dict):
+    import pyarrow.parquet as pq
+    if not os.path.isfile(fragment_file):
+        return False
+    meta = pq.read_schema(fragment_file).metadata or {}
+    return all(meta.get(key) == value for key, value in __fragment_meta(dataset_dict).items())
+
+
+def __write_fragment(fragment_file, batch, dataset_dict):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_batches([batch])
+    pq.write_table(table.replace_schema_metadata(__fragment_meta(dataset_dict)), fragment_file+'.tmp')
+    os.replace(fragment_file+'.tmp', fragment_file)
+
+
+def __prune_fragments(fragment_dir, all_scan_files, current):
+    '''
+    Remove fragments for scan files that have gone or have been rewritten.
+    Fragments of scan files excluded by FilterMIP are kept, so that
+    changing FilterMIP back does not mean parsing them again
+    '''
+    all_names = set(os.path.basename(f) for f in all_scan_files)
+    current   = set(current)
+    selected  = set(name.rsplit('.', 2)[0] for name in current)
+    for fragment in os.listdir(fragment_dir):
+        scan_name = fragment.rsplit('.', 2)[0]
+        if (scan_name not in all_names) | ((scan_name in selected) & (fragment not in current)):
+            os.remove(os.path.join(fragment_dir, fragment))
+
+
+def __build_catalogue_from_scans(dataset, dataset_dict, cat_file, max_processes=None, max_workers=None,
+                                    incremental=True):
+    '''
+    Build catalogue by reading pre-existing JSON scan files rather than
+    walking the archive. Much faster and always reflects the current state
+    of the archive.
+
+    max_processes: scan files are parsed in a pool of this many processes
+    (default taken from ~/.esmcat/config.json, see esmcat.set_config). The
+    data directories are probed in a pool of max_workers threads.
+
+    incremental: the rows from each scan file are cached as a parquet fragment
+    in ~/.esmcat/<dataset>_fragments, keyed by the scan file's name, size and
+    mtime. Only scan files that are new or have changed are parsed again.
+    '''
+    from esmcat import __esmcat_path
+
+    if max_processes is None:
+        max_processes = _get_max_processes()
+    if max_workers is None:
+        max_workers = _get_max_workers()
+
+    scan_dir       = dataset_dict['ScanDir']
+    root           = dataset_dict['Root']
+    DirStructure   = [d.split('!')[0] for d in dataset_dict['DirStructure'].split('/')]
+    columns        = DirStructure + ['StartDate', 'EndDate', 'Path', 'DataFiles']
+
+    all_scan_files = sorted(glob.glob(os.path.join(scan_dir, '*.json')))
+    scan_files     = all_scan_files
+    filter_mip = dataset_dict.get('FilterMIP')
+    if filter_mip:
+        scan_files = [f for f in scan_files
+                      if os.path.basename(f).split('.')[1] in set(filter_mip)]
+        print(f'Building {dataset} catalogue (MIPs: {filter_mip}) from {len(scan_files)} scan files...')
+    else:
+        print(f'Building {dataset} catalogue from {len(scan_files)} scan files...')
+
+    ### Reuse the fragments of scan files that have not changed
+    fragment_dir = os.path.join(__esmcat_path, dataset + '_fragments')
+    if not os.path.exists(fragment_dir):
+        os.makedirs(fragment_dir)
+    fragment_files = [os.path.join(fragment_dir, __fragment_name(f)) for f in scan_files]
+
+    valid = [incremental and __fragment_is_valid(f, dataset_dict) for f in fragment_files]
+    print(f'Parsing {valid.count(False)} new or modified scan files...')
+
+    tables = __scan_tables(scan_files, fragment_files, valid, dataset_dict, columns,
+                            max_processes, max_workers)
+    tables = __header_dates_stage(tables, dataset, max_workers)
+    n_rows = _write_parquet_stream(tables, cat_file, __scan_schema(columns), DirStructure + ['Path'],
+                                    dataset=dataset, root=root)
+    __prune_fragments(fragment_dir, all_scan_files, [os.path.basename(f) for f in fragment_files])
+    print(f'Done. {n_rows} entries written.')
+
+
+def __parse_scans(scan_files, dataset_dict, columns, max_processes, max_workers):
+    '''
+    Yield the rows of each scan file in turn (as an Arrow batch), parsing
+    them in a pool of processes if max_processes > 1. Only a few scan files
+    per process are parsed ahead of the one being yielded.
+    '''
+    if max_processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=max_processes) as procs:
+            for scan_file in scan_files:
+                pending.append(procs.submit(__scan_to_batch, scan_file, dataset_dict, columns, max_workers))
+                if len(pending) >= 4*max_processes:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for scan_file in scan_files:
+                yield __rows_to_batch(__rows_from_scan(scan_file, dataset_dict, pool), columns)
+
+
+def __scan_tables(scan_files, fragment_files, valid, dataset_dict, columns, max_processes, max_workers):
+    '''
+    Yield the rows of each scan file in the order of scan_files, read from
+    its fragment if valid, otherwise parsed (and then cached as a fragment)
+    '''
+    import pyarrow.parquet as pq
+
+    todo    = [f for f, is_valid in zip(scan_files, valid) if not is_valid]
+    batches = __parse_scans(todo, dataset_dict, columns, max_processes, max_workers)
+
+    for fragment_file, is_valid in zip(fragment_files, valid):
+        if is_valid:
+            yield pq.read_table(fragment_file).replace_schema_metadata(None)
+        else:
+            batch = next(batches)
+            __write_fragment(fragment_file, batch, dataset_dict)
+            yield batch
+
+
+def __list_subdirs(path, name=None):
+    '''
+    List the directories below path, as glob would for one level of the
+    file walk (name=None for '*', otherwise a literal name, e.g. 'latest').
+    os.scandir gives us the d_type of each entry, so (unlike glob followed by
+    os.path.isdir/islink) we do not stat every entry again.
+    Returns a list of (name, is_symlink)
+    '''
+    if name is not None:
+        subdir = os.path.join(path, name)
+        if os.path.isdir(subdir):
+            return [(name, os.path.islink(subdir))]
+        return []
+
+    try:
+        with os.scandir(path) as entries:
+            ### glob's '*' ignores hidden names (e.g., '.ftpaccess')
+            return [ (e.name, e.is_symlink()) for e in entries
+                        if (e.name[0] != '.') and e.is_dir() ]
+    except OSError:
+        return []
+
+
+def __list_files(path, name=None):
+    return os.listdir(path)
+
+
+def __probe_dir(path, lister, name, manifest):
+    '''
+    Run lister(path, name), or when the directory has not been modified
+    since it was last listed, reuse the listing held in the manifest.
+    Returns (listing, mtime, reused)
+    '''
+    if manifest is None:
+        return lister(path, name), None, False
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return lister(path, name), None, False
+
+    cached = manifest.get(path)
+    if (cached is not None) and (cached[0] == mtime):
+        return cached[1], mtime, True
+
+    ### Directories modified within the last couple of seconds may change again
+    ### within the resolution of the file system clock, so always re-list these
+    if (time.time_ns() - mtime) < 2e9: mtime = -1
+
+    return lister(path, name), mtime, False
 
 
-def read_parquet(fname):
-    import pyarrow.parquet as pq
-    schema       = pq.read_schema(fname)
-    meta         = schema.metadata or {}
-    file_version = int(meta.get(b'catalogue_version', b'0'))
-    if __catalogue_version > file_version:
-        raise ValueError('Your catalogue needs to be updated to work with this version of the code')
-    df = pd.read_parquet(fname)
-    print('catalogue memory usage (MB):', df.memory_usage().sum() * 0.000001)
-    return df
+def __walk_archive(root, filewalk, max_workers, manifest=None, records=None):
+    '''
+    Walk the archive one DirStructure level at a time, listing all directories
+    of a level concurrently in a bounded thread pool. Directories are returned
+    in the same order as glob.glob(root+filewalk).
+    Returns a list of (path, links) where links are the symlinked directories
+    found on the way (needed to resolve e.g. latest -> v20120709)
+
+    manifest: {path: (mtime, listing)} from a previous walk, directories whose
+    mtime is unchanged are not listed again. The listing of every directory
+    walked is added to records
+    '''
+    from concurrent.futures import ThreadPoolExecutor
 
+    top   = root.rstrip('/') or '/'
+    links = (top,) if os.path.islink(top) else ()
+    nodes = [(top, links)]
 
-def _read_csv_legacy(fname, dataset):
-    dataset_dict = dataset_dictionaries[dataset]
-    if 'dtypes' in dataset_dict:
-        df = pd.read_csv(fname, comment='#', dtype=dataset_dict['dtypes'])
-    else:
-        df = pd.read_csv(fname, comment='#')
-    df['dataset'] = dataset
-    return df.astype({'dataset': 'category'})
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for name in filewalk:
+            n = len(nodes)
+            probes = pool.map(__probe_dir, [node[0] for node in nodes], [__list_subdirs]*n,
+                                    [name]*n, [manifest]*n)
+            next_nodes = []
+            for (path, links), (subdirs, mtime, reused) in zip(nodes, probes):
+                if records is not None: records[path] = (mtime, subdirs, reused)
+                for subdir, is_link in subdirs:
+                    subpath = os.path.join(path, subdir)
+                    next_nodes.append((subpath, links + (subpath,) if is_link else links))
+            nodes = next_nodes
 
+    return nodes
 
 
-def __build_catalogue_from_scans(dataset, dataset_dict, cat_file):
+def __resolve_symlinks(path, n_root_levels, islink=os.path.islink, readlink=os.readlink):
     '''
-    Build catalogue by reading pre-existing JSON scan files rather than
-    walking the archive. Much faster and always reflects the current state
-    of the archive.
+    Resolve symlinks to real directory names (e.g. latest -> v20120709)
     '''
-    import json as _json
+    parts = path.split('/')
+    for i in range(n_root_levels, len(parts)+1):
+        if islink('/'.join(parts[0:i])):
+            realpath = readlink('/'.join(parts[0:i]))
+            if len(realpath.split('/')) == 1:
+                path = '/'.join(parts[0:i-1]) + '/' + realpath + '/' + '/'.join(parts[i:])
+    return path
 
-    scan_dir       = dataset_dict['ScanDir']
-    root           = dataset_dict['Root']
-    InclExtensions = dataset_dict['InclExtensions']
-    DirStructure   = [d.split('!')[0] for d in dataset_dict['DirStructure'].split('/')]
 
-    scan_files = sorted(glob.glob(os.path.join(scan_dir, '*.json')))
-    filter_mip = dataset_dict.get('FilterMIP')
-    if filter_mip:
-        scan_files = [f for f in scan_files
-                      if os.path.basename(f).split('.')[1] in set(filter_mip)]
-        print(f'Building {dataset} catalogue (MIPs: {filter_mip}) from {len(scan_files)} scan files...')
-    else:
-        print(f'Building {dataset} catalogue from {len(scan_files)} scan files...')
+def __dir_files(path, fnames, InclExtensions):
+    '''
+    Data files within a directory found when walking the archive
+    '''
+    fnames = [fn for fn in fnames if any(fn.endswith(ext) for ext in InclExtensions)]
+    for fn in fnames:
+        if len(fn.split('.')) != 2:
+            print('Ignoring '+path+'/'+fn)
+            fnames.pop(fnames.index(fn))
+    return fnames
 
-    rows = []
-    for scan_file in scan_files:
-        with open(scan_file) as f:
-            scan = _json.load(f)
 
-        for ds in scan.get('drs_datasets', []):
-            directory = ds['directory']
+def __read_manifest(manifest_file, dataset_dict):
+    '''
+    Read the sub-directory listings recorded by the last refresh, one row group at a time.
+    The file listings of data directories (an entry for every data file in the archive)
+    are not read here, only the row each is in, see __manifest_listings
+    Returns ({path: (mtime, listing)}, {path: row}), or None if there is no usable manifest
+    '''
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
 
-            if not os.path.isdir(directory):
-                continue
+    if not os.path.isfile(manifest_file):
+        return None
+
+    meta = pq.read_schema(manifest_file).metadata or {}
+    if (meta.get(b'catalogue_version') != str(__catalogue_version).encode()) | \
+       (meta.get(b'Root')              != dataset_dict['Root'].encode()) | \
+       (meta.get(b'DirStructure')      != dataset_dict['DirStructure'].encode()):
+        print('Manifest does not match the current dataset definition, ignoring it')
+        return None
+
+    pf        = pq.ParquetFile(manifest_file)
+    manifest  = {}
+    data_rows = {}
+    start     = 0
+    for i in range(pf.num_row_groups):
+        table  = pf.read_row_group(i, columns=['Path', 'Links'])
+        is_dir = pc.is_valid(table['Links'])
+        paths  = table['Path'].to_pylist()
+        if pc.any(is_dir).as_py():
+            dirs = pf.read_row_group(i).filter(is_dir)
+            for path, mtime, names, links in zip(*[dirs[c].to_pylist() for c in
+                                                    ['Path', 'MTime', 'Entries', 'Links']]):
+                manifest[path] = (mtime, list(zip(names, links)))
+        for row, (path, d) in enumerate(zip(paths, is_dir.to_pylist())):
+            if not d: data_rows[path] = start + row
+        start += table.num_rows
+    return manifest, data_rows
+
+
+def __manifest_listings(manifest_file, paths, data_rows):
+    '''
+    The file listings recorded by the last refresh for those data directories in paths
+    (a chunk of the walk) which are in the manifest, reading only the row groups holding them
+    Returns {path: (mtime, listing)}
+    '''
+    import pyarrow.parquet as pq
 
-            # Parse column values from drs_id, skipping the leading 'CMIP6' token
-            # e.g. CMIP6.AerChemMIP.BCC.BCC-ESM1.hist-piNTCF.r1i1p1f1.Amon.ch4.gn.v20190621
-            parts = ds['drs_id'].split('.')[1:]
+    found = [ (data_rows[path], path) for path in paths if path in data_rows ]
+    if len(found) == 0: return {}
+    found.sort()
+    rows  = np.array([ row for row, path in found ])
 
-            fnames = [fn for fn in os.listdir(directory)
-                      if any(fn.endswith(ext) for ext in InclExtensions)
-                      and len(fn.split('.')) == 2]
+    pf     = pq.ParquetFile(manifest_file)
+    starts = np.cumsum([0] + [ pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups) ])
+    groups = np.searchsorted(starts, rows, side='right') - 1
+    listings = {}
+    for i in np.unique(groups):
+        ind   = np.flatnonzero(groups == i)
+        table = pf.read_row_group(int(i), columns=['MTime', 'Entries']).take(rows[ind] - starts[i])
+        for j, mtime, names in zip(ind, table['MTime'].to_pylist(), table['Entries'].to_pylist()):
+            listings[found[j][1]] = (mtime, names)
+    return listings
 
-            if not fnames:
-                continue
 
-            start_dates, end_dates = get_file_date_ranges(fnames, dataset_dict['FilenameStructure'])
+def __manifest_table(records):
+    '''
+    The mtime and listing of each directory walked. For sub-directory
+    listings Links flags which entries are symlinks, for data directories
+    (where Entries holds the file names) it is null
+    '''
+    import pyarrow as pa
 
-            if np.all(np.isnan(start_dates)):
-                continue
+    paths, mtimes, entries, links = [], [], [], []
+    for path, (mtime, listing, reused) in records.items():
+        if mtime is None: continue
+        paths.append(path)
+        mtimes.append(mtime)
+        if (len(listing) > 0) and isinstance(listing[0], tuple):
+            entries.append([l[0] for l in listing])
+            links.append([l[1] for l in listing])
+        else:
+            entries.append(list(listing))
+            links.append(None)
 
-            rows.append(parts + [
-                int(np.nanmin(start_dates)),
-                int(np.nanmax(end_dates)),
-                directory,
-                ';'.join(fnames)
-            ])
+    return pa.table({'Path':    pa.array(paths,   pa.string()),
+                     'MTime':   pa.array(mtimes,  pa.int64()),
+                     'Entries': pa.array(entries, pa.list_(pa.string())),
+                     'Links':   pa.array(links,   pa.list_(pa.bool_())) })
 
-    df = pd.DataFrame(rows, columns=DirStructure + ['StartDate', 'EndDate', 'Path', 'DataFiles'])
-    write_parquet(df, cat_file, dataset=dataset, root=root)
-    print(f'Done. {len(df)} entries written.')
+
+def __manifest_writer(manifest_file, dataset_dict):
+    '''
+    Open a writer for the manifest, written to a temporary file until complete
+    '''
+    import pyarrow.parquet as pq
+    meta = {b'catalogue_version': str(__catalogue_version).encode(),
+            b'Root':              dataset_dict['Root'].encode(),
+            b'DirStructure':      dataset_dict['DirStructure'].encode()}
+    return pq.ParquetWriter(manifest_file+'.tmp', __manifest_table({}).schema.with_metadata(meta))
 
 
-def __refresh_shared_catalogue(dataset):
+def __refresh_shared_catalogue(dataset, max_workers=None, incremental=True):
     '''
     Rebuild the catalogue
+
+    max_workers: number of threads used to walk the archive (default taken
+    from ~/.esmcat/config.json, see esmcat.set_config)
+
+    incremental: directories are only listed again if their mtime has changed
+    since the last refresh (as recorded in <dataset>_manifest.parquet), the
+    listings of all other directories are taken from the manifest. The file listings
+    of data directories are read from the manifest one chunk of directories at a time,
+    so at most row_group_size catalogue rows are held as for a full rebuild (the
+    record of each directory still grows with the archive). For datasets
+    built from scan files, only new or modified scan files are parsed again
     '''
 
     if dataset not in dataset_dictionaries.keys():
         raise ValueError("The keyword 'dataset' needs to be set and recognisable in order to refresh catalogue")
 
     from esmcat import __esmcat_path
-    cat_file     = os.path.join(__esmcat_path, dataset + '_catalogue.parquet')
-    dataset_dict = dataset_dictionaries[dataset]
+    if not os.path.exists(__esmcat_path):
+        os.makedirs(__esmcat_path)
+    cat_file      = os.path.join(__esmcat_path, dataset + '_catalogue.parquet')
+    manifest_file = os.path.join(__esmcat_path, dataset + '_manifest.parquet')
+    dataset_dict  = dataset_dictionaries[dataset]
 
     if 'ScanDir' in dataset_dict:
-        __build_catalogue_from_scans(dataset, dataset_dict, cat_file)
+        __build_catalogue_from_scans(dataset, dataset_dict, cat_file, max_workers=max_workers,
+                                        incremental=incremental)
         return
 
+    if max_workers is None:
+        max_workers = _get_max_workers()
+
     root           = dataset_dict['Root']
     DirStructure   = dataset_dict['DirStructure'].split('/')
-    InclExtensions = dataset_dict['InclExtensions']
 
-    ### Get paths for data
-    filewalk = ''
+    ### Directory name to match at each level of the walk (None for any directory)
+    filewalk = []
     for i, D in enumerate(DirStructure):
         if '!' in D:
-            filewalk = filewalk + '/' + D.split('!')[1]
+            filewalk.append(D.split('!')[1])
             DirStructure[i] = D.split('!')[0]
         else:
-            filewalk = filewalk + '/*'
+            filewalk.append(None)
 
-    print('Building '+dataset+' catalogue now...')
-    paths = glob.glob(root+filewalk)
-    paths = filter(lambda f: os.path.isdir(f), paths)
+    manifest = None
+    if incremental and os.path.isfile(cat_file):
+        manifest = __read_manifest(manifest_file, dataset_dict)
+
+    if manifest is None:
+        print('Building '+dataset+' catalogue now...')
+        manifest, data_rows = {}, {}
+    else:
+        manifest, data_rows = manifest
+        print('Updating '+dataset+' catalogue (only re-listing modified directories)...')
+
+    records = {}
+    nodes   = __walk_archive(root, filewalk, max_workers, manifest=manifest, records=records)
 
-    rows = []
     n_root_levels = len(dataset_dict['Root'].split('/'))
-    for path in paths:
+    readlink      = functools.lru_cache(maxsize=None)(os.readlink)
+    paths = [ __resolve_symlinks(path, n_root_levels, islink=set(links).__contains__, readlink=readlink)
+                for path, links in nodes ]
+
+    manifest_writer = __manifest_writer(manifest_file, dataset_dict)
+    manifest_writer.write_table(__manifest_table(records))
+    n_listed = sum(not reused for mtime, listing, reused in records.values())
+
+    def tables():
+        ### List the data directories and build their rows one row group at a time
+        nonlocal n_listed
+        from concurrent.futures import ThreadPoolExecutor
+        row_group_size = _get_row_group_size()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for i in range(0, len(paths), row_group_size):
+                chunk    = paths[i:i+row_group_size]
+                n        = len(chunk)
+                listings = __manifest_listings(manifest_file, chunk, data_rows)
+                probes   = pool.map(__probe_dir, chunk, [__list_files]*n, [None]*n, [listings]*n)
+                dirs    = []
+                records = {}
+                for path, (fnames, mtime, reused) in zip(chunk, probes):
+                    records[path] = (mtime, fnames, reused)
+                    n_listed     += (not reused)
+                    parts = path.split('/')[n_root_levels:]
+                    if '' in parts: parts.remove('')
+                    dirs.append((parts, path, __dir_files(path, fnames, dataset_dict['InclExtensions'])))
+                manifest_writer.write_table(__manifest_table(records))
+                yield __rows_to_batch(__dirs_to_rows(dirs, dataset_dict['FilenameStructure']), columns)
+
+    columns = DirStructure + ['StartDate', 'EndDate', 'Path', 'DataFiles']
+    try:
+        _write_parquet_stream(__header_dates_stage(tables(), dataset, max_workers), cat_file,
+                                __scan_schema(columns), DirStructure + ['Path'], dataset=dataset, root=root)
+    finally:
+        manifest_writer.close()
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+    print(f'Listed {n_listed} of {len(records) + len(paths)} directories')
 
-        ### Resolve symlinks to real directory names (e.g. latest -> v20120709)
-        parts = path.split('/')
-        for i in range(n_root_levels, len(parts)+1):
-            if os.path.islink('/'.join(parts[0:i])):
-                realpath = os.readlink('/'.join(parts[0:i]))
-                if len(realpath.split('/')) == 1:
-                    path = '/'.join(parts[0:i-1]) + '/' + realpath + '/' + '/'.join(parts[i:])
 
-        parts = path.split('/')[n_root_levels:]
-        if '' in parts: parts.remove('')
+def get_file_date_ranges(fnames, filename_structure):
+    ### Get start and end dates from file names
+    fnames = list(fnames)
+    start_dates, end_dates, unparsed = get_file_date_ranges_batch(fnames, filename_structure)
+
+    for i in np.flatnonzero(unparsed):
+        ### Can't define date
+        ###### To do: if no date_range then get from ncdump -h ? !!
+        print('Cannot identify dates '+os.path.splitext(fnames[i])[0])
 
-        fnames = [fn for fn in os.listdir(path) if any(fn.endswith(ext) for ext in InclExtensions)]
-        for fn in fnames:
-            if len(fn.split('.')) != 2:
-                print('Ignoring '+path+'/'+fn)
-                fnames.pop(fnames.index(fn))
-        files_str = ';'.join(fnames)
+    start_dates = np.where(unparsed, np.nan, start_dates)
+    end_dates   = np.where(unparsed, np.nan, end_dates)
+    return start_dates, end_dates
 
-        if len(fnames) > 0:
-            start_date, end_date = get_file_date_ranges(fnames, dataset_dict['FilenameStructure'])
-            parts.append(int(np.nanmin(start_date)))
-            parts.append(int(np.nanmax(end_date)))
-            parts.append(path)
-            parts.append(files_str)
-            rows.append(parts)
 
-    df = pd.DataFrame(rows, columns=DirStructure + ['StartDate', 'EndDate', 'Path', 'DataFiles'])
-    write_parquet(df, cat_file, dataset=dataset, root=root)
+def get_file_date_ranges_batch(fnames, filename_structure):
+    '''
+    Get start and end dates from a whole batch of file names at once, using
+    vectorised (Arrow) string operations rather than a loop over the names
 
+    Returns start_dates and end_dates as int64 arrays, and a boolean mask of
+    the names whose dates could not be identified (their dates are set to 0)
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
 
+    ind   = filename_structure.split('_').index('StartDate-EndDate')
+    names = pa.array(list(fnames), pa.string())
 
+    start_dates = np.zeros(len(names), dtype=np.int64)
+    end_dates   = np.zeros(len(names), dtype=np.int64)
+    found       = np.zeros(len(names), dtype=bool)
+    if len(names) == 0:
+        return start_dates, end_dates, ~found
 
+    names = pc.replace_substring_regex(names, pattern=r'\.[^.]*$', replacement='') # rm extention
 
-def get_file_date_ranges(fnames, filename_structure):
-    ### Get start and end dates from file names
-    ind = filename_structure.split('_').index('StartDate-EndDate')
-    start_dates, end_dates = np.array([]), np.array([])
+    ### Fixed variable (e.g., land-mask)
+    fixed = pc.match_substring_regex(names, '_(fx|Efx|Ofx)_').to_numpy(zero_copy_only=False)
+    found |= fixed
 
-    for fname in list(fnames):
+    ### Time-varying (e.g., temperature)
+    date_str = pc.extract_regex(names, '^(?:[^_]*_){%d}(?P<date_str>[^_]*)' % ind).flatten()[0]
 
-        fname = os.path.splitext(fname)[0] # rm extention
+    def match(pattern):
+        matched = pc.extract_regex(date_str, pattern)
+        dates   = [pc.cast(d, pa.int64()).fill_null(0).to_numpy() for d in matched.flatten()]
+        matched = matched.is_valid().to_numpy(zero_copy_only=False) & ~found
+        return [matched] + dates
 
-        ### Is this file time-varying?
-        if ('_fx_' in fname) | ('_Efx_' in fname) | ('_Ofx_' in fname):
-            ### Fixed variable (e.g., land-mask)
-            start_date, end_date = 0, 0
+    ### e.g.,'19900101-20000101'
+    matched, start, end = match(r'^(?P<start>\d{1,18})-(?P<end>\d{1,18})$')
+    start_dates[matched], end_dates[matched] = start[matched], end[matched]
+    found |= matched
 
-        else:
-            ### Time-varying (e.g., temperature)
-            date_str = fname.split('_')[ind].split('-')
-
-            ### Interpreting the dates
-            if len(date_str) == 2:
-                ### e.g.,'19900101-20000101'
-                start_date, end_date = int(date_str[0]), int(date_str[1])
-
-            elif (len(date_str) == 3):
-                if (date_str[2] == 'clim'):
-                    ### e.g.,'186001-187912-clim'
-                    ### see /badc/cmip5/data/cmip5/output1/MOHC/HadGEM2-ES/piControl/mon/atmos/Amon/r1i1p1/latest/pfull
-                    start_date, end_date = int(date_str[0]+'01'), int(date_str[1]+'31')
-                else:
-                    print('Cannot identify dates '+fname)
-
-            elif (len(date_str) == 1) & (int(date_str[0]) >= 1800) & (int(date_str[0]) <= 2300):
-                ### e.g., '1990'
-                ### see /badc/cmip5/data/cmip5/output1/ICHEC/EC-EARTH/amip/subhr/atmos/cfSites/r3i1p1/latest/ccb
-                start_date, end_date = int(date_str[0]), int(date_str[0])
+    ### e.g.,'186001-187912-clim'
+    ### see /badc/cmip5/data/cmip5/output1/MOHC/HadGEM2-ES/piControl/mon/atmos/Amon/r1i1p1/latest/pfull
+    matched, start, end = match(r'^(?P<start>\d{1,16})-(?P<end>\d{1,16})-clim$')
+    start_dates[matched], end_dates[matched] = start[matched]*100 + 1, end[matched]*100 + 31
+    found |= matched
 
-            else:
-                ### Can't define date
-                ###### To do: if no date_range then get from ncdump -h ? !!
-                print('Cannot identify dates '+fname)
-                start_date, end_date = np.nan, np.nan
+    ### e.g., '1990'
+    ### see /badc/cmip5/data/cmip5/output1/ICHEC/EC-EARTH/amip/subhr/atmos/cfSites/r3i1p1/latest/ccb
+    matched, year = match(r'^(?P<year>\d{1,18})$')
+    matched &= (year >= 1800) & (year <= 2300)
+    start_dates[matched], end_dates[matched] = year[matched], year[matched]
+    found |= matched
 
-        start_dates = np.append( start_dates, start_date )
-        end_dates   = np.append( end_dates,   end_date )   
+    return start_dates, end_dates, ~found
 
-    return start_dates, end_dates       
+
+def __full_dates(dates, end=False):
+    '''
+    Dates given to any precision (e.g., 1990, 199001, 19900101 or 199001010000) as
+    YYYYMMDDhhmm, taking the first (or if end=True the last) minute of the period, so
+    that dates of different precision can be compared. Unknown dates (e.g., NaN or
+    0 for fixed fields) -> -1
+    '''
+    dates  = pd.to_numeric(pd.Series(np.asarray(dates).ravel()), errors='coerce').to_numpy(dtype=float)
+    known  = np.isfinite(dates) & (dates > 0)
+    digits = np.where(known, np.floor(np.log10(np.where(known, dates, 1))) + 1, 0).astype(int)
+    dates  = np.where(known, dates, 0).astype(np.int64)
+
+    full = np.full(len(dates), -1, dtype=np.int64)
+    pads = {4:(1010000, 12312359), 6:(10000, 312359), 8:(0, 2359), 10:(0, 59), 12:(0, 0)}
+    for n, (first, last) in pads.items():
+        ind       = digits == n
+        full[ind] = dates[ind] * 10**(12-n) + (last if end else first)
+    ind       = digits == 14
+    full[ind] = dates[ind] // 100
+    return full
+
+
+def __date_arg(date, end=False):
+    '''
+    A start_date/end_date argument (e.g., 19900101, '1990-01-01', '1990' or a datetime) as YYYYMMDDhhmm
+    '''
+    if date is None: return None
+    if hasattr(date, 'strftime'): date = date.strftime('%Y%m%d%H%M')
+    digits = str(date).replace('-', '').replace(' ', '').replace(':', '').replace('T', '')
+    if (not digits.isdigit()) or (len(digits) not in (4, 6, 8, 10, 12, 14)):
+        raise ValueError('Can not interpret date '+repr(date)+', use YYYYMMDD (e.g., 19900101)')
+    return int(__full_dates([int(digits)], end=end)[0])
+
+
+def __overlaps(start_dates, end_dates, start_date=None, end_date=None):
+    '''
+    Which of the periods start_dates to end_dates overlap start_date to end_date?
+    (periods with unknown dates are kept)
+    '''
+    starts = __full_dates(start_dates)
+    ends   = __full_dates(end_dates, end=True)
+    keep   = np.ones(len(starts), dtype=bool)
+    start_date, end_date = __date_arg(start_date), __date_arg(end_date, end=True)
+    if start_date is not None: keep &= (ends < 0) | (ends >= start_date)
+    if end_date   is not None: keep &= (starts < 0) | (starts <= end_date)
+    return keep
 
 
 
@@ -343,7 +1767,10 @@ def __combine_dictionaries(keys, dict1_in, dict2_in):
     return dict1
 
 
-def __create_unique_run_identifer(catlg, col_name):
+def __run_columns(catlg):
+    '''
+    Columns which identify a model run (all directory levels except Var)
+    '''
     dataset = catlg['dataset'].iloc[0]
     dataset_dict = dataset_dictionaries[dataset]
     my_list = dataset_dict['DirStructure'].replace('Var','').split('/')
@@ -351,7 +1778,30 @@ def __create_unique_run_identifer(catlg, col_name):
     if ('Version!latest' in my_list): # plan to remove !latest from datasets.py (should read all data then take newest version where all Vars exist)
         my_list.remove('Version!latest')
         my_list = my_list + ['Version']
-    catlg.loc[:,col_name] = catlg[my_list].apply(lambda x: '_'.join(x), axis=1)
+    return my_list
+
+
+def __run_group_ids(catlg):
+    '''
+    Integer id (0, 1, 2... in order of first appearance) of each row's model run
+    '''
+    if len(catlg) == 0: return np.zeros(0, dtype=np.int64)
+    return catlg.groupby(__run_columns(catlg), sort=False, observed=True, dropna=False).ngroup().to_numpy()
+
+
+def __create_unique_run_identifer(catlg, col_name, ids=None):
+    '''
+    Add a column naming each row's model run (e.g., MOHC_HadGEM2-ES_historical_..._v20120202),
+    the name is only built once for each run
+    '''
+    if ids is None: ids = __run_group_ids(catlg)
+    if len(catlg) == 0:
+        catlg[col_name] = pd.Series(dtype=object)
+        return catlg
+    my_list = __run_columns(catlg)
+    first   = np.unique(ids, return_index=True)[1]
+    names   = np.array([ '_'.join(x) for x in catlg[my_list].iloc[first].astype(str).values ], dtype=object)
+    catlg[col_name] = names[ids]
     return catlg
 
 
@@ -378,17 +1828,17 @@ def __complete_var_set(catlg, filt_dict):
             'unique run \n')
 
     # create unique identifier for each unique run
-    catlg = __create_unique_run_identifer(catlg, 'Unique_Model_Run')
+    ids   = __run_group_ids(catlg)
+    catlg = __create_unique_run_identifer(catlg.copy(), 'Unique_Model_Run', ids)
 
-    # number of Vars in each model-run-version group
-    catlg_gp = catlg.groupby(['Unique_Model_Run']).count().max(axis=1)
+    # number of different Vars in each model-run-version group
+    var_codes = pd.factorize(catlg['Var'])[0]
+    n_codes   = max(var_codes.max() + 1, 1) if len(var_codes) > 0 else 1
+    pairs     = np.unique(ids.astype(np.int64) * n_codes + var_codes)
+    n_vars    = np.bincount(pairs // n_codes, minlength=ids.max() + 1 if len(ids) > 0 else 0)
 
     # select groups where we have the correct number of variables 
-    catlg_gp = catlg_gp[ catlg_gp == nVars ]
-
-    # filter whole catalogue
-    catlg = catlg[ catlg.isin({'Unique_Model_Run':catlg_gp.index}
-                                )['Unique_Model_Run'] == True ]
+    catlg = catlg[ n_vars[ids] == nVars ]
 
     if len(catlg) == 0:
         raise ValueError('There are no rows where all specified Vars exist for Model-RunID-Version',
@@ -398,10 +1848,17 @@ def __complete_var_set(catlg, filt_dict):
 
 
 
-def __filter_cat_by_dictionary(catlg, cat_dict, complete_var_set=False):
+def __filter_cat_by_dictionary(catlg, cat_dict, complete_var_set=False, index=None, dates=None,
+                                check_values=True):
     '''
     Get rows which match cat_dict
+    index: the index of catlg's columns (see __build_index), used to find
+    the rows without scanning the columns
+    dates: (start_date, end_date), only keep rows with data between these dates
+    check_values: raise an error if a value is not in catlg, turned off where the values
+    have already been checked against the whole catalogue file (see __check_values_exist)
     '''
+    if index is None: index = {}
     keys  = cat_dict.keys()
 
     for key in keys:
@@ -410,20 +1867,36 @@ def __filter_cat_by_dictionary(catlg, cat_dict, complete_var_set=False):
         if (cat_dict[key].__class__ == str):        cat_dict[key] = [cat_dict[key]]
         if (cat_dict[key].__class__ == np.bytes_): cat_dict[key] = [cat_dict[key]]
 
+        if check_values == False: continue
         vals     = cat_dict[key]
-        col_set  = set(catlg[key])
+        col_set  = index[key] if key in index else set(catlg[key])
 
         for val in vals:
             if (val not in col_set):
                 print('Are you sure that data exists that satisfy all your constraints?')
+                available = np.array(list(index[key].keys())) if key in index else pd.unique(catlg[key])
                 raise ValueError(val+' not found. See available in current catalouge: ' \
-                                    +np.array_str(pd.unique(catlg[key])) )
+                                    +np.array_str(available) )
+
+    ### Rows matching the indexed keys (starting with the key matching fewest rows)
+    rows = [ __index_rows(index[key], cat_dict[key]) for key in keys if key in index ]
+    if len(rows) > 0:
+        rows.sort(key=len)
+        selected = rows[0]
+        for r in rows[1:]:
+            if len(selected) == 0: break
+            ind      = np.minimum(np.searchsorted(r, selected), len(r)-1)
+            selected = selected[r[ind] == selected]
+        catlg = catlg.iloc[selected]
 
     mask = pd.Series(True, index=catlg.index)
     for key, vals in cat_dict.items():
-        mask &= catlg[key].isin(vals)
+        if key not in index: mask &= catlg[key].isin(vals)
     catlg = catlg[mask]
 
+    if (dates is not None) and (dates != (None, None)) and ('StartDate' in catlg.columns):
+        catlg = catlg[ __overlaps(catlg['StartDate'], catlg['EndDate'], *dates) ]
+
     if 'Var' in cat_dict.keys():
         if (complete_var_set == False) & (len(cat_dict['Var']) > 1):
             print('More than one Var specified, consider setting complete_var_set=True')
@@ -434,6 +1907,68 @@ def __filter_cat_by_dictionary(catlg, cat_dict, complete_var_set=False):
     return catlg
 
 
+def __index_rows(col_index, vals):
+    '''
+    Sorted positions of rows with any of vals
+    '''
+    rows = [ col_index[val] for val in set(vals) if val in col_index ]
+    if len(rows) == 0: return np.array([], dtype=np.int64)
+    if len(rows) == 1: return rows[0]
+    return np.sort(np.concatenate(rows))
+
+
+def __build_index(catlg):
+    '''
+    For each column of strings (except Path and DataFiles), map each value to the
+    sorted positions of the rows with that value, so that rows can be selected
+    (and values checked) without scanning the columns.
+    Returns the index and its size in bytes
+    '''
+    index  = {}
+    nbytes = 0
+    dtype  = np.int32 if len(catlg) < 2**31 else np.int64
+    for key in catlg.columns:
+        if key in __lazy_columns: continue
+        if not (pd.api.types.is_object_dtype(catlg[key]) or pd.api.types.is_string_dtype(catlg[key]) or
+                isinstance(catlg[key].dtype, pd.CategoricalDtype)): continue
+
+        codes, uniques = pd.factorize(catlg[key])
+        order   = np.argsort(codes, kind='stable').astype(dtype)
+        counts  = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        order   = order[np.sum(codes < 0):]   ### drop missing values
+        splits  = np.split(order, np.cumsum(counts)[:-1]) if len(uniques) > 0 else []
+        index[key] = { val:rows for val, rows in zip(uniques, splits) if len(rows) > 0 }
+        nbytes += order.nbytes
+    return index, nbytes
+
+
+def __covers(cached_filters, needed_values):
+    '''
+    Have all rows matching needed_values been read into a catalogue filtered by cached_filters?
+    '''
+    for key, vals in cached_filters.items():
+        if key not in needed_values.keys(): return False
+        if not set(needed_values[key]) <= set(vals): return False
+    return True
+
+
+def __check_values_exist(cat_file, catlg, cat_dict):
+    '''
+    Raise an error if values are not found in the whole catalogue file. The
+    (filtered) catalogue which has been read is checked first so the file is
+    only re-read when a value is missing
+    '''
+    import pyarrow.parquet as pq
+    for key, vals in cat_dict.items():
+        col_set = set(catlg[key])
+        if all(val in col_set for val in vals): continue
+        available = pd.unique(pq.read_table(cat_file, columns=[key]).column(key).to_pandas())
+        available = np.asarray(available, dtype=str)
+        for val in vals:
+            if (val not in available):
+                print('Are you sure that data exists that satisfy all your constraints?')
+                raise ValueError(val+' not found. See available in current catalouge: ' \
+                                    +np.array_str(available) )
 
 
 def __compare_dict(dict1_in, dict2_in):
@@ -474,108 +2009,139 @@ def __compare_dict(dict1_in, dict2_in):
 
 
 
-def catalogue(dataset=None, refresh=None, complete_var_set=False, read_everything=False, **kwargs):
-    """
-    
-    Read whole dataset catalogue for JASMIN (default: dataset='cmip5')
-       >>> catlg = ecat.catalogue(dataset='cmip6')
-
-    Look at the first row to get a feel for the catologue layout
-       >>> print(catlg.iloc[0])
-
-    Read filtered catalogue for JASMIN (
-    (Note to help with filtering, you can use any CASE for kwargs + some common shortened words (freq, exp, run) )
-       >>> cat = ecat.catalogue(dataset='cmip5', experiment=['amip','historical'], var='tas', frequency=['mon'])
-
-    complete_var_set = True: return a complete set where all Variables belong to the run
-    (Useful when combining multiple variables to derive another diagnostic)
-       >>> cat = ecat.catalogue(var=['tas','psl','tasmax'], complete_var_set=True)
-
-    refresh = True: refresh the shared cataloge 
-    This should only be run when new data has been uploaded into the data archive
-       >>> cat = ecat.catalogue(dataset='cmip5', refresh=True)
-
-    read_everything = True
-    By default, ecat.catalogue only stores those items defined by 'Cached' within datasets.json
-    This option by-passes that and reads the whole catalogue (which could be very large!)
-
-    """
-
-    global __cached_cat
-    global __cached_values
-    global __default_dataset
-    global __current_dataset
-    global __orig_cached_values
-
-    update_cached_cat = False
+def __update_cached_cat(session, dataset, lazy, cached, needed_values, user_values):
+    '''
+    Read the rows needed_values from the catalogue file into the cache of
+    Catalogue session (with the lock for dataset held, see Catalogue.dataset_lock).
+    If rows were previously read (cached) then read enough to cover both (only
+    keeping restrictions common to both). The rows held are only replaced once
+    the new rows have been read, so other queries are not stopped while the file is read
+    '''
+    if cached is not None:
+        needed_values = { key:list(set(cached['filters'][key]) | set(needed_values[key]))
+                            for key in cached['filters'].keys() if key in needed_values.keys() }
 
+    ### Setup catalogue
+    cat_file    = setup_catalogue_file(dataset)
+    arrow_cache = _get_arrow_cache()
+    partitions  = None if arrow_cache else __setup_partitions(dataset, cat_file)
+
+    print('Updating cached catalogue...')
+    session.cache.count(hit=False)
+    cached_cat = read_parquet(cat_file, filters=needed_values, lazy=lazy,
+                                partitions=partitions, arrow_cache=arrow_cache)
+    ### check the user's values first so that errors refer to them
+    __check_values_exist(cat_file, cached_cat,
+                            { key:needed_values[key] for key in sorted(needed_values.keys(),
+                                                                key=lambda k: k not in user_values) })
+    index, index_nbytes = __build_index(cached_cat)
+    versions = __version_numbers(cached_cat, dataset)
+    cached   = {'cat':cached_cat, 'file':cat_file, 'filters':needed_values, 'index':index, 'versions':versions,
+                'results':_LRUCache()}
+    session.cache.put((dataset, lazy), cached,
+                        int(cached_cat.memory_usage(deep=True).sum()) + index_nbytes + versions.nbytes,
+                    (session.cache_size_mb or _get_cache_size_mb()) * 1e6)
+    if cached['filters'] != {}:
+        print('>> Current cached values (can be extended by specifying additional values or by setting read_everything=True) <<')
+        print(cached['filters'])
+        print('')
+    return cached
+
+
+def _query_catalogue(session, dataset=None, refresh=None, complete_var_set=False, read_everything=False,
+                        lazy=None, run_group=False, latest_version=False, start_date=None, end_date=None, **kwargs):
+    '''
+    Filter the catalogue of a dataset, using (and updating) the catalogues held
+    by Catalogue session (see catalogue)
+    '''
     ### Ensure we have a dataset specified - use default if none specified by user
     if (dataset == None):
-        print("Warning: dataset not specified, defaulting to: dataset='"+__default_dataset+"'")
-        dataset = __default_dataset
+        dataset_dictionaries.load()
+        print("Warning: dataset not specified, defaulting to: dataset='"+dataset_dictionaries.default_dataset+"'")
+        dataset = dataset_dictionaries.default_dataset
 
     if dataset not in dataset_dictionaries.keys():
-        raise ValueError(dataset+' dataset not currently available: '+str(dataset_dictionaries.keys())+ \
+        raise ValueError(dataset+' dataset not currently available: '+str(list(dataset_dictionaries.keys()))+ \
                             '. \n You can add new datasets within dataset.py')
 
     ### Define cached values for requested catalogue
-    __cached_values = dataset_dictionaries[dataset]['Cached']        
-
-    __orig_cached_values = __cached_values.copy()
+    cached_values      = dataset_dictionaries[dataset]['Cached']
+    orig_cached_values = cached_values.copy()
 
-    ### First time using specified dataset
-    if (dataset != __current_dataset):
-        update_cached_cat = True
-        __current_dataset = dataset
+    ### Read only the columns needed for filtering?
+    if lazy is None:
+        lazy = _get_lazy()
 
-    ### Refresh catalogue csv file (i.e., re-scan dataset directories and rebuild catalogue)
-    if (refresh == True): 
-        __refresh_shared_catalogue(dataset)
-        update_cached_cat = True
-
-    ### Setup catalogue
-    cat_file = setup_catalogue_file(dataset)
+    ### Refresh catalogue file (i.e., re-scan dataset directories and rebuild catalogue)
+    if (refresh == True) | (refresh == 'full'):
+        with session.dataset_lock(dataset):
+            __refresh_shared_catalogue(dataset, incremental=(refresh != 'full'))
+            session.cache.pop((dataset, False))
+            session.cache.pop((dataset, True))
 
     ### Read whole catalogue (AND RETURN)
     if read_everything == True:
-        cat = read_parquet(cat_file)
+        with session.dataset_lock(dataset):
+            cat_file = setup_catalogue_file(dataset)
+            cat      = read_parquet(cat_file, lazy=lazy, arrow_cache=_get_arrow_cache())
         print(">> Read whole catalogue, any filtering has been ignored <<")
         return cat
 
-    ### Read catalgoue for the first time
-    if (type(__cached_cat) == list):    
-        update_cached_cat = True
-
     ### Get user defined filter/dictionary from kwargs
     user_values = kwargs.copy()
 
     if (complete_var_set == True) & ('Var' not in user_values.keys()):
         raise ValueError('complete_var_set only works when you specify two or more variables (Vars)')
 
-    ### Update/expand cached catalogue
-    ### Add any additional items from user for only those keys already defined in cached_cat (ignore other keys from user)
-    expanded_cached_values = __combine_dictionaries(__cached_values.keys(), __cached_values, user_values)
-    compare_dicts          = __compare_dict(expanded_cached_values, __cached_values)
-    if (compare_dicts == 'different'): update_cached_cat = True
+    ### Only rows with data between these dates (checked here so bad dates fail straight away)
+    dates = (__date_arg(start_date), __date_arg(end_date, end=True))
 
+    ### Rows needed for this query: the cached values (extended by any additional items from
+    ### the user for those keys) and the user's values for all other keys
+    needed_values = __combine_dictionaries(set(cached_values.keys()) | set(user_values.keys()),
+                                            cached_values, user_values)
 
-    ### To do: Edit user keys if they exist but with a different case or shortened !!
+    ### Can the query be answered from the rows already read for this dataset?
+    ### (cached is None if not read or dropped from the cache)
+    cached = session.cache.get((dataset, lazy))
+    update_cached_cat = (cached is None) or (__covers(cached['filters'], needed_values) == False)
 
+    ### To do: Edit user keys if they exist but with a different case or shortened !!
 
     if (update_cached_cat == True):
-        print('Updating cached catalogue...')
-        __cached_cat    = read_parquet(cat_file)
-        __cached_values = expanded_cached_values.copy()
-        __cached_cat    = __filter_cat_by_dictionary( __cached_cat, __cached_values )
-        if __cached_values != {}:
-            print('>> Current cached values (can be extended by specifying additional values or by setting read_everything=True) <<')
-            print(__cached_values)
-            print('')
+        with session.dataset_lock(dataset):
+            ### (another thread may have read it while waiting for the lock)
+            cached = session.cache.get((dataset, lazy))
+            if (cached is None) or (__covers(cached['filters'], needed_values) == False):
+                cached = __update_cached_cat(session, dataset, lazy, cached, needed_values, user_values)
+            else:
+                session.cache.count(hit=True)
+    else:
+        session.cache.count(hit=True)
+
+    ### Has the same query been made since the catalogue was read?
+    query_key = __query_key(user_values, complete_var_set, latest_version, dates)
+    rows      = cached['results'].get(query_key)
+    if rows is not None:
+        cached['results'].count(hit=True)
+        cat = cached['cat'].iloc[rows]
+        if complete_var_set == True:
+            cat = __create_unique_run_identifer(cat.copy(), 'Unique_Model_Run')
+        return __add_run_group(cat) if run_group else cat
+    cached['results'].count(hit=False)
 
     if user_values != {}:
 
+        ### The values of keys the cached rows were read with have been checked against
+        ### the whole catalogue file, so that a combination of values which matches no rows
+        ### returns an empty catalogue (rather than an error). Check any other keys the same way
+        unchecked = { key:needed_values[key] for key in user_values.keys() if key not in cached['filters'] }
+        if unchecked != {}:
+            __check_values_exist(cached['file'], cached['cat'], unchecked)
+
         ### Produce the catalogue for user
-        cat = __filter_cat_by_dictionary( __cached_cat, user_values, complete_var_set=complete_var_set )
+        cat = __filter_cat_by_dictionary( cached['cat'], user_values, complete_var_set=complete_var_set,
+                                            index=cached['index'], dates=dates, check_values=False )
 
         # Some Var names are duplicated across SubModels (e.g., Var='pr')
         # Force code to fall over if we spot more than one unique SubModel
@@ -601,20 +2167,200 @@ def catalogue(dataset=None, refresh=None, complete_var_set=False, read_everythin
     else:
 
         ### If no user_values are specified then read in default/original list of cached values
-        if __cached_values == {}:
+        if cached_values == {}:
             print('No user values defined, retrieving whole catalogue')
         else:
             print('No user values defined, will therefore filter catalogue using default values')
 
-        cat = __filter_cat_by_dictionary(__cached_cat, __orig_cached_values)
+        cat = __filter_cat_by_dictionary(cached['cat'], orig_cached_values, index=cached['index'], dates=dates)
 
+    if latest_version == True:
+        cat = __latest_version(cat, cached, complete_var_set)
+
+    rows = cached['cat'].index.get_indexer(cat.index)
+    cached['results'].put(query_key, rows, rows.nbytes, _get_result_cache_mb() * 1e6)
+
+    return __add_run_group(cat) if run_group else cat
+
+
+def __add_run_group(cat):
+    '''
+    Add RunGroup: an integer id for each model run, e.g. to loop over runs
+       >>> for run_id, run in cat.groupby('RunGroup'):
+    '''
+    cat = cat.copy()
+    cat['RunGroup'] = __run_group_ids(cat)
     return cat
 
 
+def __latest_version(cat, cached, complete_var_set):
+    '''
+    Only keep the rows with the newest Version of each run (and Var, unless
+    complete_var_set where each run's Versions have already been reduced to those with all Vars)
+    '''
+    if ('Version' not in cat.columns) or (len(cat) == 0): return cat
+    versions = cached['versions'][cached['cat'].index.get_indexer(cat.index)]
+    keys     = [ c for c in __run_columns(cat) if c != 'Version' ]
+    if complete_var_set == False: keys = keys + ['Var']
+    newest   = pd.Series(versions).groupby(cat.groupby(keys, sort=False, observed=True, dropna=False).ngroup().to_numpy()).transform('max')
+    return cat[ versions == newest.to_numpy() ]
+
+
+def __version_numbers(catlg, dataset):
+    '''
+    Versions as integers which sort in order of release (e.g., 'v20110101' -> 20110101,
+    versions which are not numbers (e.g., 'latest') -> -1). For models listed in
+    NumericVersionLaterModels (within datasets.json), numeric versions (e.g., 'v1')
+    are later than date-like versions
+    '''
+    if 'Version' not in catlg.columns: return np.zeros(0, dtype=np.int64)
+    codes, uniques = pd.factorize(catlg['Version'])
+    numbers  = pd.to_numeric(pd.Series(np.asarray(uniques, dtype=str)).str.lstrip('v'), errors='coerce')
+    numbers  = numbers.fillna(-1).to_numpy().astype(np.int64)
+    versions = np.where(codes >= 0, numbers[codes], -1)
+    later    = dataset_dictionaries[dataset].get('NumericVersionLaterModels', [])
+    if (len(later) > 0) and ('Model' in catlg.columns):
+        versions[ catlg['Model'].isin(later).to_numpy() & (versions >= 0) & (versions < 2000_00_00) ] += 1_000_000_000
+    return versions
+
+
+def __query_key(user_values, complete_var_set, latest_version=False, dates=(None, None)):
+    '''
+    Key for the results of a query, which is the same however the values were given
+    (e.g., Var='tas' or Var=['tas','tas'])
+    '''
+    key = []
+    for k in sorted(user_values.keys()):
+        vals = user_values[k]
+        if (vals.__class__ == str) | (vals.__class__ == np.bytes_): vals = [vals]
+        key.append( (k, tuple(sorted(set(vals), key=str))) )
+    return (tuple(key), bool(complete_var_set), bool(latest_version), tuple(dates))
+
+
+
+
+
+
+
+
+
+class Catalogue(object):
+    '''
+    Holds the catalogues read for each dataset so that they can be filtered
+    (from many threads at once) without re-reading the catalogue files
+       >>> cat = ecat.Catalogue()
+       >>> df  = cat.query(dataset='cmip6', Experiment='historical', Var='tas', CMOR='Amon')
+
+    Catalogues held are never changed once read (they are replaced as a whole), so any
+    number of threads can filter them at the same time. Reading a catalogue file, or
+    refreshing the catalogue, is done by one thread at a time for each dataset (see
+    dataset_lock) without stopping other queries.
+
+    cache_size_mb: memory (MB) for catalogues held (default: esmcat.set_config(cache_size_mb=N) or 2000)
+    '''
+
+    def __init__(self, cache_size_mb=None):
+        self.cache         = _LRUCache()
+        self.cache_size_mb = cache_size_mb
+        self.dataset_locks = {}
+        self.mutex         = threading.Lock()
+
+    def dataset_lock(self, dataset):
+        '''
+        Lock held while the catalogue of dataset is read or refreshed, so that only
+        one thread reads (or rebuilds) each catalogue at a time
+        '''
+        with self.mutex:
+            return self.dataset_locks.setdefault(dataset, threading.Lock())
+
+    def query(self, dataset=None, refresh=None, complete_var_set=False, read_everything=False, lazy=None,
+                run_group=False, latest_version=False, start_date=None, end_date=None, **kwargs):
+        '''
+        Filter a dataset catalogue, see esmcat.catalogue
+        '''
+        return _query_catalogue(self, dataset=dataset, refresh=refresh, complete_var_set=complete_var_set,
+                                read_everything=read_everything, lazy=lazy, run_group=run_group,
+                                latest_version=latest_version, start_date=start_date, end_date=end_date, **kwargs)
+
+    def cache_info(self):
+        '''
+        Statistics for the catalogues held, see esmcat.catalogue_cache_info
+        '''
+        info    = self.cache.info()
+        results = [ cached['results'].info() for cached in self.cache.values() ]
+        for stat in ['hits', 'misses', 'evictions', 'bytes']:
+            info['result_'+stat] = sum(r[stat] for r in results)
+        return info
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+### Catalogue used by catalogue()
+_default_catalogue = Catalogue()
+
+
+def catalogue(dataset=None, refresh=None, complete_var_set=False, read_everything=False, lazy=None,
+                run_group=False, latest_version=False, start_date=None, end_date=None, **kwargs):
+    """
+    
+    Read whole dataset catalogue for JASMIN (default: dataset='cmip5')
+       >>> catlg = ecat.catalogue(dataset='cmip6')
+
+    Look at the first row to get a feel for the catologue layout
+       >>> print(catlg.iloc[0])
+
+    Read filtered catalogue for JASMIN (
+    (Note to help with filtering, you can use any CASE for kwargs + some common shortened words (freq, exp, run) )
+       >>> cat = ecat.catalogue(dataset='cmip5', experiment=['amip','historical'], var='tas', frequency=['mon'])
+
+    complete_var_set = True: return a complete set where all Variables belong to the run
+    (Useful when combining multiple variables to derive another diagnostic)
+       >>> cat = ecat.catalogue(var=['tas','psl','tasmax'], complete_var_set=True)
+
+    latest_version = True: only return the newest Version of each run (e.g. for dataset='cmip5_all_versions'),
+    with complete_var_set=True this is the newest Version in which all the Vars exist
+       >>> cat = ecat.catalogue(dataset='cmip5_all_versions', var=['tas','pr'], frequency='day',
+                                complete_var_set=True, latest_version=True)
+
+    run_group = True: add a RunGroup column, an integer id for each model run
+    (e.g., to loop over the runs with cat.groupby('RunGroup'))
+
+    start_date, end_date: only return rows with data between these dates (YYYYMMDD, or to
+    any precision, e.g., 1990 or '1990-01'), see also get_files(start_date=, end_date=)
+       >>> cat = ecat.catalogue(dataset='cmip6', Var='tas', CMOR='day', start_date=19700101, end_date=19991231)
+
+    refresh = True: refresh the shared cataloge 
+    This should only be run when new data has been uploaded into the data archive
+       >>> cat = ecat.catalogue(dataset='cmip5', refresh=True)
+    Only directories modified since the last refresh are re-listed. To re-list everything use
+       >>> cat = ecat.catalogue(dataset='cmip5', refresh='full')
+
+    lazy = True: only read the columns needed for filtering (not Path or DataFiles), saving memory.
+    These are read for the selected rows when needed (get_files, open_dataset or add_file_columns)
+    The default can be changed with esmcat.set_config(lazy=True)
+       >>> cat = ecat.catalogue(dataset='cmip6', Var='tas', CMOR='Amon', lazy=True)
+
+    read_everything = True
+    By default, ecat.catalogue only stores those items defined by 'Cached' within datasets.json
+    This option by-passes that and reads the whole catalogue (which could be very large!)
+
+    """
+
+    return _default_catalogue.query(dataset=dataset, refresh=refresh, complete_var_set=complete_var_set,
+                                    read_everything=read_everything, lazy=lazy, run_group=run_group,
+                                    latest_version=latest_version, start_date=start_date, end_date=end_date, **kwargs)
+
+
 
 
 
-def get_files(df):
+def get_files(df, start_date=None, end_date=None):
+    '''
+    Full paths of the files of a single row of the catalogue
+    start_date, end_date: only return the files with data between these dates (YYYYMMDD)
+       >>> files = ecat.get_files(cat.iloc[0], start_date=19700101, end_date=19991231)
+    '''
 
     if ('Series' in str(type(df))):
         df = pd.DataFrame([df.values], columns=df.keys())
@@ -626,6 +2372,8 @@ def get_files(df):
     if len(df) != 1:
         raise ValueError('DataFrame should only have one row. e.g., df.iloc[i]')
 
+    df = add_file_columns(df)
+
     dataset        = df['dataset'].iloc[0]
     dataset_dict   = dataset_dictionaries[dataset]
     root           = dataset_dict['Root']
@@ -634,9 +2382,156 @@ def get_files(df):
     files     = df['DataFiles'].values[0].split(';')
     files     = [ directory+f for f in files ]
 
+    ### Only the files overlapping the requested dates
+    if (start_date is not None) | (end_date is not None):
+        start_dates, end_dates, unparsed = get_file_date_ranges_batch(
+                                                [ os.path.basename(f) for f in files ], dataset_dict['FilenameStructure'])
+        keep  = __overlaps(np.where(unparsed, np.nan, start_dates), np.where(unparsed, np.nan, end_dates),
+                            start_date, end_date)
+        files = [ f for f, k in zip(files, keep) if k ]
+        if len(files) == 0:
+            raise ValueError('No files within requested date range in '+directory)
+
     list_file_extensions = [file.split('.')[-1] for file in files]
     if len(set(list_file_extensions)) > 1:
         # Should we automatically select which extension to use?? (i.e., .nc vs .nc4) !!
         raise ValueError('>> WARNING: Multiple file extensions present in '+directory+' <<')
 
     return files
+
+
+
+def add_file_columns(df):
+    '''
+    Add the Path and DataFiles columns to a catalogue read with lazy=True
+    (reading them for these rows only). Returns df unchanged if they are already present
+       >>> cat = ecat.catalogue(dataset='cmip6', Var='tas', CMOR='Amon', lazy=True)
+       >>> cat = ecat.add_file_columns(cat)
+    '''
+    missing = [ c for c in __lazy_columns if c not in df.columns ]
+    if (len(missing) == 0) | ('RowKey' not in df.columns): return df
+
+    df       = df.copy()
+    datasets = df['dataset'].astype(str).to_numpy()
+    row_keys = df['RowKey'].to_numpy()
+    values   = { c:np.empty(len(df), dtype=object) for c in missing }
+    for dataset in pd.unique(datasets):
+        ind  = np.flatnonzero(datasets == dataset)
+        rows = _read_rows(setup_catalogue_file(dataset), row_keys[ind], missing)
+        for c in missing: values[c][ind] = rows[c].values
+    for c in missing: df[c] = values[c]
+    return df
+
+
+
+def _row_names(df):
+    '''
+    Name of each row: its model run and Var (e.g., MOHC_HadGEM2-ES_historical_..._v20120202_tas),
+    with the row's index added to any names which are not unique
+    '''
+    if len(df) == 0: return []
+    names = __create_unique_run_identifer(df[['dataset'] + __run_columns(df)].copy(), 'name')['name']
+    if 'Var' in df.columns: names = names + '_' + df['Var'].astype(str)
+    names = names.to_numpy().astype(object)
+    dup   = pd.Series(names).duplicated(keep=False).to_numpy()
+    names[dup] = names[dup] + '_' + df.index[dup].astype(str).to_numpy()
+    return list(names)
+
+
+
+def _member_columns(df):
+    '''
+    Columns which tell the rows apart (the run columns and Var with more than one value)
+    '''
+    if len(df) == 0: return []
+    return [ c for c in __run_columns(df) + ['Var'] if (c in df.columns) and (df[c].nunique() > 1) ]
+
+
+
+def get_file_table(df, columns=None, start_date=None, end_date=None):
+    '''
+    One row per file for the rows of a catalogue (read from the file table of each
+    catalogue, written when first needed, see write_file_table), with columns
+       Row:       index of the catalogue row the file belongs to
+       File:      full path of the file
+       StartDate, EndDate: dates of the file (from its name, null if they can not be identified)
+       Size:      size of the file in bytes (null if it could not be found), only looked
+                  up for the files asked for, which are remembered for next time
+    so that files can be selected, counted and sized without splitting DataFiles, e.g.
+       >>> files = ecat.get_file_table(cat)
+       >>> cat['NFiles'] = files.groupby('Row').size()
+       >>> cat['Size']   = files.groupby('Row')['Size'].sum()
+    columns: only return these columns (e.g., ['Row', 'Size'])
+    start_date, end_date: only return the files with data between these dates (YYYYMMDD)
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if ('Series' in str(type(df))):
+        df = pd.DataFrame([df.values], columns=df.keys(), index=[df.name])
+    if 'DataFrame' not in str(type(df)):
+        raise ValueError('Not a DataFrame')
+    if columns is None:
+        columns = ['Row', 'File', 'StartDate', 'EndDate', 'Size']
+
+    if 'Path' not in df.columns: df = add_file_columns(df)
+    datasets = df['dataset'].astype(str).to_numpy()
+    path_ids = __path_ids(df['Path'].to_numpy())
+    tables   = []
+    for dataset in pd.unique(datasets):
+        ind   = np.flatnonzero(datasets == dataset)
+        ids   = path_ids[ind]
+        cat_file = setup_catalogue_file(dataset)
+        table = ds.dataset(__setup_file_table(dataset, cat_file), format='parquet').to_table(
+                    filter=ds.field('PathID').isin(pa.array(np.unique(ids))))
+
+        ### Files of each row (the table is sorted by PathID)
+        table_ids = table.column('PathID').to_numpy()
+        order     = np.argsort(table_ids, kind='stable')
+        first     = np.searchsorted(table_ids[order], ids, side='left')
+        counts    = np.searchsorted(table_ids[order], ids, side='right') - first
+        rows      = np.repeat(np.arange(len(ids)), counts)
+        take      = order[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        if (start_date is not None) | (end_date is not None):
+            keep  = __overlaps(table.column('StartDate').take(pa.array(take)).to_pandas(),
+                                table.column('EndDate').take(pa.array(take)).to_pandas(), start_date, end_date)
+            rows, take = rows[keep], take[keep]
+
+        files = pd.DataFrame({'Row':df.index[ind][rows], 'position':ind[rows]})
+        names = table.column('Name').take(pa.array(take)).to_numpy(zero_copy_only=False)
+        root  = dataset_dictionaries[dataset]['Root']
+        paths = root + df['Path'].iloc[ind[rows]].astype(str).to_numpy().astype(object) + '/' + names
+        if 'File' in columns:
+            files['File'] = paths
+        for c in ['StartDate', 'EndDate']:
+            if c in columns:
+                files[c] = table.column(c).take(pa.array(take)).to_pandas().astype('Int64')
+        if 'Size' in columns:
+            sizes = __file_sizes(cat_file, table.column('PathID').take(pa.array(take)).to_numpy(), names, paths)
+            files['Size'] = pd.array(np.where(sizes < 0, None, sizes).tolist(), dtype='Int64')
+        tables.append(files)
+
+    if len(tables) == 0: return pd.DataFrame(columns=columns)
+    files = pd.concat(tables, ignore_index=True)
+    files = files.iloc[np.argsort(files['position'].to_numpy(), kind='stable')].reset_index(drop=True)
+    return files[columns]
+
+
+
+def catalogue_cache_info():
+    '''
+    Statistics for the catalogues held in memory: number of catalogue() calls answered
+    from memory (hits) or which needed to read the catalogue file (misses), number of
+    catalogues dropped to stay within the memory budget (evictions, see
+    esmcat.set_config(cache_size_mb=N)), bytes held and which are held (dataset_lazy).
+    result_hits etc. give the same for the results of previous queries of these catalogues
+    (see esmcat.set_config(result_cache_mb=N))
+    '''
+    return _default_catalogue.cache_info()
+
+
+def clear_catalogue_cache():
+    '''
+    Drop all catalogues held in memory
+    '''
+    _default_catalogue.clear_cache()
@@ -0,0 +1,290 @@
+'''
+Index of the time coordinate (and layout) of each data file, kept beside the
+catalogues in ~/.esmcat/time_index, so that a run split across many files can be
+opened without reading the header of every file each time (see open_dataset)
+'''
+
+import os, json as _json, hashlib, threading, datetime
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+
+### Bump this if the contents of the index change, so that old indexes are rebuilt
+__index_version = 1
+
+### Index files being updated by this process
+__index_lock = threading.Lock()
+
+
+
+def _get_time_index():
+    '''
+    Should open_dataset use (and build) the time index by default?
+    '''
+    from esmcat import get_config
+    return bool(get_config().get('time_index', False))
+
+
+def index_file(directory):
+    '''
+    Index file for the data files within directory
+    '''
+    from esmcat import __esmcat_path
+    name = hashlib.sha1(os.path.normpath(directory).encode()).hexdigest()
+    return os.path.join(__esmcat_path, 'time_index', name+'.json')
+
+
+def __json_value(value):
+    if isinstance(value, np.ndarray): return value.tolist()
+    if isinstance(value, np.generic): return value.item()
+    if isinstance(value, bytes):      return value.decode(errors='replace')
+    return value
+
+
+def __time_name(ds):
+    '''
+    Name of the time coordinate of a (not decoded) dataset, None if there is not one
+    '''
+    if ('time' in ds.variables) and (ds['time'].ndim == 1): return 'time'
+    for name, var in ds.variables.items():
+        if (var.ndim == 1) and ((var.attrs.get('standard_name') == 'time') or (var.attrs.get('axis') == 'T')):
+            return name
+    return None
+
+
+def __read_header(file):
+    '''
+    Index entry of one file: its size and mtime, time values (as stored, with their
+    units and calendar), and the dims, dtype and attributes of each variable
+    '''
+    st = os.stat(file)
+    with xr.open_dataset(file, decode_cf=False) as ds:
+        time_name = __time_name(ds)
+        entry = {'size':st.st_size, 'mtime_ns':st.st_mtime_ns, 'time_name':time_name,
+                 'dims':{ d:int(n) for d, n in ds.sizes.items() },
+                 'attrs':{ k:__json_value(v) for k, v in ds.attrs.items() },
+                 'variables':{}, 'coords':{}}
+        for name, var in ds.variables.items():
+            entry['variables'][name] = {'dims':list(var.dims), 'dtype':str(var.dtype),
+                                        'attrs':{ k:__json_value(v) for k, v in var.attrs.items() }}
+            ### Values of (small) dimension coordinates, e.g., lat and lon
+            if (var.dims == (name,)) and (name != time_name):
+                entry['coords'][name] = var.values.tolist()
+        if time_name is not None:
+            entry['time']     = ds[time_name].values.tolist()
+            entry['units']    = ds[time_name].attrs.get('units')
+            entry['calendar'] = ds[time_name].attrs.get('calendar', 'standard')
+    return entry
+
+
+def header_dates(file):
+    '''
+    First and last dates (YYYYMMDD) of a file, read from its time variable (and its
+    bounds) rather than its name. Returns (None, None) if they can not be read
+    '''
+    from xarray.coding.times import decode_cf_datetime
+    try:
+        with xr.open_dataset(file, decode_cf=False) as ds:
+            time_name = __time_name(ds)
+            if (time_name is None) or (ds.sizes[ds[time_name].dims[0]] == 0): return None, None
+            time   = ds[time_name]
+            values = time.values
+            first  = values[0]
+            last   = values[-1]
+            ### (the bounds of the first and last times, if there are bounds, as dates from
+            ### file names give the start of the first period and the end of the last)
+            bounds = time.attrs.get('bounds')
+            upper  = False
+            if (bounds in ds.variables) and (ds[bounds].ndim == 2):
+                first = min(first, ds[bounds].values[0].min())
+                upper = ds[bounds].values[-1].max() > last
+                last  = max(last, ds[bounds].values[-1].max())
+            dates  = decode_cf_datetime(np.array([first, last]), time.attrs['units'],
+                                        time.attrs.get('calendar', 'standard'))
+    except Exception:
+        return None, None
+    dates = [ d if hasattr(d, 'year') else __timestamp(d) for d in dates ]
+    ### (an upper bound is the start of the next period, e.g. 1st of the next month)
+    if upper: dates[1] = dates[1] - datetime.timedelta(microseconds=1)
+    return tuple( int(d.year*10000 + d.month*100 + d.day) for d in dates )
+
+
+def __timestamp(date):
+    import pandas as pd
+    return pd.Timestamp(date)
+
+
+def __load_index(fname):
+    if not os.path.isfile(fname): return {}
+    try:
+        with open(fname) as f:
+            index = _json.load(f)
+    except ValueError:
+        return {}
+    if index.get('version') != __index_version: return {}
+    return index.get('files', {})
+
+
+def __save_index(fname, entries):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_file = fname+'.'+str(os.getpid())+'-'+str(threading.get_ident())+'.tmp'
+    with open(tmp_file, 'w') as f:
+        _json.dump({'version':__index_version, 'files':entries}, f)
+    os.replace(tmp_file, fname)
+
+
+def setup_time_index(files):
+    '''
+    Index entries of files (see __read_header), read from the index of their
+    directory. Headers are only read for files which are new or have changed
+    since the index was written (the index is then updated)
+    Returns {file: entry}
+    '''
+    entries = {}
+    for directory in sorted(set(os.path.dirname(f) for f in files)):
+        fname   = index_file(directory)
+        with __index_lock:
+            index = __load_index(fname)
+        changed = False
+        for file in [ f for f in files if os.path.dirname(f) == directory ]:
+            name  = os.path.basename(file)
+            entry = index.get(name)
+            st    = os.stat(file)
+            if (entry is None) or (entry['size'] != st.st_size) or (entry['mtime_ns'] != st.st_mtime_ns):
+                entry, changed = __read_header(file), True
+                index[name] = entry
+            entries[file] = entry
+        if changed:
+            ### (re-read in case another thread has added files since)
+            with __index_lock:
+                index = dict(__load_index(fname), **{ os.path.basename(f):e for f, e in entries.items()
+                                                        if os.path.dirname(f) == directory })
+                __save_index(fname, index)
+    return entries
+
+
+def _read_raw(file, name, key):
+    '''
+    Read (not decoded) values of variable name from file, key: a tuple of slices/integer arrays
+    '''
+    with xr.open_dataset(file, decode_cf=False) as ds:
+        return np.asarray(ds[name].variable[key].values)
+
+
+class _FilesArray(BackendArray):
+    '''
+    A variable stored in several files, one after another along dimension axis
+    (or in a single file if axis is None), which only reads the files needed
+    for the values selected
+    '''
+
+    def __init__(self, files, name, shape, dtype, axis, offsets):
+        self.files   = files
+        self.name    = name
+        self.shape   = tuple(shape)
+        self.dtype   = np.dtype(dtype)
+        self.axis    = axis
+        self.offsets = np.asarray(offsets)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.OUTER, self._getitem)
+
+    def _getitem(self, key):
+        key = tuple(key)
+        if self.axis is None:
+            return _read_raw(self.files[0], self.name, key)
+
+        ### Positions selected along axis, and which file each is in
+        k         = key[self.axis]
+        positions = np.arange(self.shape[self.axis])[k]
+        scalar    = np.ndim(positions) == 0
+        positions = np.atleast_1d(positions)
+        if len(positions) == 0:
+            return _read_raw(self.files[0], self.name, key[:self.axis] + (slice(0, 0),) + key[self.axis+1:])
+        in_file   = np.searchsorted(self.offsets, positions, side='right') - 1
+
+        parts = []
+        for i in np.unique(in_file):
+            sel   = np.flatnonzero(in_file == i)
+            local = positions[sel] - self.offsets[i]
+            if np.all(np.diff(local) == 1):
+                local = slice(int(local[0]), int(local[-1])+1)
+            file_key = key[:self.axis] + (local,) + key[self.axis+1:]
+            parts.append((sel, _read_raw(self.files[i], self.name, file_key)))
+
+        axis = self.axis - sum(isinstance(k, (int, np.integer)) for k in key[:self.axis])
+        if len(parts) == 1:
+            out = parts[0][1]
+        else:
+            shape       = list(parts[0][1].shape)
+            shape[axis] = len(positions)
+            out         = np.empty(shape, dtype=parts[0][1].dtype)
+            for sel, values in parts:
+                index       = [slice(None)]*len(shape)
+                index[axis] = sel
+                out[tuple(index)] = values
+        return np.take(out, 0, axis=axis) if scalar else out
+
+
+def __can_combine(entries):
+    '''
+    Can the files be combined using their index entries alone? They need a time coordinate
+    (with the same units and calendar), the same variables and, apart from the length
+    of time, the same dims
+    '''
+    first = entries[0]
+    if (first['time_name'] is None) or (first['units'] is None): return False
+    for e in entries[1:]:
+        if (e['time_name'] != first['time_name']) or (e['variables'].keys() != first['variables'].keys()):
+            return False
+        if (e['units'] != first['units']) or (e['calendar'] != first['calendar']):
+            return False
+        if any(e['dims'][d] != n for d, n in first['dims'].items() if d != first['time_name']):
+            return False
+        for name, var in first['variables'].items():
+            if (e['variables'][name]['dims'] != var['dims']) or (e['variables'][name]['dtype'] != var['dtype']):
+                return False
+    return True
+
+
+def open_indexed_dataset(files, entries=None):
+    '''
+    Open files (a run split along time) as one dataset, built from their time index
+    (see setup_time_index) rather than by reading each file's header. Data is only
+    read (from just the files needed) when the values are used.
+    Returns None if the files can not be combined this way
+    '''
+    if entries is None: entries = setup_time_index(files)
+    entries = [ entries[f] for f in files ]
+    if not __can_combine(entries): return None
+
+    ### Files in time order
+    order   = np.argsort([ e['time'][0] if len(e['time']) > 0 else np.inf for e in entries ], kind='stable')
+    files   = [ files[i] for i in order ]
+    entries = [ entries[i] for i in order ]
+
+    first     = entries[0]
+    time_name = first['time_name']
+    lengths   = [ e['dims'][time_name] for e in entries ]
+    offsets   = np.cumsum([0] + lengths[:-1])
+    dims      = dict(first['dims'], **{ time_name:int(sum(lengths)) })
+
+    variables = {}
+    for name, var in first['variables'].items():
+        if name == time_name:
+            data = np.concatenate([ np.asarray(e['time'], dtype=var['dtype']) for e in entries ])
+        elif name in first['coords']:
+            data = np.asarray(first['coords'][name], dtype=var['dtype'])
+        elif time_name in var['dims']:
+            data = indexing.LazilyIndexedArray(_FilesArray(files, name, [ dims[d] for d in var['dims'] ], var['dtype'],
+                                                            var['dims'].index(time_name), offsets))
+        else:
+            data = indexing.LazilyIndexedArray(_FilesArray(files, name, [ dims[d] for d in var['dims'] ], var['dtype'],
+                                                            None, [0]))
+        variables[name] = xr.Variable(var['dims'], data, attrs=var['attrs'])
+
+    ds = xr.decode_cf(xr.Dataset(variables, attrs=first['attrs']))
+    ds.encoding['source'] = files[0]
+    return ds
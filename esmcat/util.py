@@ -42,6 +42,39 @@ def extract_region(da, bounds):
     return da
 
 
+def subset(ds, region=None, time=None):
+    """
+    Select a region and time period of a Dataset (or DataArray), without loading any data
+    region: bounds as for extract_region, e.g. {'lat_bnds':[30,70], 'lon_bnds':[-20,40]}
+    (longitudes can be given as -180 to 180 or 0 to 360 whichever the data uses)
+    time:   e.g. slice('1970-01-01', '1999-12-31')
+    """
+    if (time is not None) and ('time' in ds.dims):
+        ds = ds.sel(time=time)
+
+    if region is not None:
+        if ('lat' not in ds.dims) or ('lon' not in ds.dims):
+            raise ValueError('region needs data with 1-D lat and lon coordinates')
+
+        lat_bnds = sorted(region['lat_bnds'])
+        if (ds['lat'].size > 1) and (ds['lat'][0] > ds['lat'][-1]): lat_bnds = lat_bnds[::-1]
+        ds = ds.sel(lat=slice(*lat_bnds))
+
+        lon_bnds = list(region['lon_bnds'])
+        if lon_bnds[1] - lon_bnds[0] < 360:
+            lon = ds['lon']
+            if lon.min() < 0:
+                lon_bnds = [ ((l + 180) % 360) - 180 for l in lon_bnds ]
+            else:
+                lon_bnds = [ l % 360 for l in lon_bnds ]
+            if lon_bnds[0] <= lon_bnds[1]:
+                ds = ds.sel(lon=slice(*lon_bnds))
+            else:
+                ### region crosses the edge of the grid (e.g., 340 to 40 on a 0-360 grid)
+                ds = ds.isel(lon=((lon >= lon_bnds[0]) | (lon <= lon_bnds[1])).values)
+    return ds
+
+
 def extract_ts_nearest_neighbour(da, coord):
     da = da.interp( coords={'lat':coord['lat'], 'lon':coord['lon']},
                     method='nearest')